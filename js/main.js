@@ -57,23 +57,40 @@ switch (process.platform) {
 }
 
 
+// Shown until the server reports it's ready
+const loadingPage = "data:text/html;charset=utf-8," + encodeURIComponent(
+  "<html><body style='font-family: sans-serif; padding: 2em'>Starting Bonsai DCA...</body></html>"
+);
+
+// Delay between readiness checks
+const readyPollInterval = 100;
+
+
 function loadUrlWhenReady() {
-  fetch(serverURL)
+  // `/ready` answers as soon as the server is listening, before the db is migrated
+  //  and without rendering a page.
+  fetch(serverURL + "/ready")
     .then(
       function(response) {
         if (response.status == 200) {
           console.log("Loading url");
           mainWindow.loadURL(serverURL);
           return
+        } else if (response.status == 500) {
+          return response.json().then(function(data) {
+            console.log(data);
+            mainWindow.loadURL("data:text/html;charset=utf-8," + encodeURIComponent(
+              "<html><body style='font-family: sans-serif; padding: 2em'>Bonsai DCA failed to start: " + data.error + "</body></html>"
+            ));
+          });
         } else {
-          console.log(response);
-          return loadUrlWhenReady();
+          setTimeout(loadUrlWhenReady, readyPollInterval);
         }
       }
     )
     .catch(function(err) {
       if (err.code == 'ECONNREFUSED' | err.code == 'EINVAL') {
-        return loadUrlWhenReady();
+        setTimeout(loadUrlWhenReady, readyPollInterval);
       } else {
         console.log(err);
       }
@@ -86,6 +103,7 @@ app.whenReady().then(() => {
   try {
     console.log("Creating the window")
     createWindow()
+    mainWindow.loadURL(loadingPage)
 
     app.on('activate', function () {
       if (BrowserWindow.getAllWindows().length === 0) createWindow()
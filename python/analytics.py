@@ -0,0 +1,253 @@
+import datetime
+
+from peewee import JOIN, Case, fn
+
+from models import db, Fill, Order, PriceSnapshot
+
+
+
+# Orders that can carry an execution: fully filled, or cancelled after a partial fill
+FILLED_STATUSES = (Order.STATUS__COMPLETE, Order.STATUS__CANCELLED)
+
+
+
+def sync_fills():
+    """
+        Copies newly executed orders into `Fill` with a single INSERT ... SELECT;
+        reads only `Order`'s summary columns, never `raw_data`. Returns the number of
+        rows added.
+    """
+    query = Order.select(
+        Order.id,
+        Order.credential,
+        Order.schedule,
+        Order.market_name,
+        Order.order_side == "buy",
+        Order.executed_amount,
+        Order.executed_amount * Order.avg_execution_price,
+        fn.COALESCE(Order.fee, 0),
+        fn.COALESCE(Order.updated, Order.created),
+    ).join(
+        Fill, JOIN.LEFT_OUTER, on=(Fill.order == Order.id)
+    ).where(
+        Fill.id.is_null() &
+        (Order.is_live == False) &
+        Order.status.in_(FILLED_STATUSES) &
+        (Order.executed_amount > 0) &
+        Order.avg_execution_price.is_null(False)
+    )
+
+    with db.atomic():
+        return Fill.insert_from(query, [
+            Fill.order,
+            Fill.credential,
+            Fill.schedule,
+            Fill.market_name,
+            Fill.is_buy,
+            Fill.quantity,
+            Fill.notional,
+            Fill.fee,
+            Fill.filled_at,
+        ]).as_rowcount().execute()
+
+
+
+def record_price_snapshot(exchange: str, market_name: str, price):
+    PriceSnapshot.create(exchange=exchange, market_name=market_name, price=float(price))
+
+
+
+def latest_prices(exchange: str, market_names):
+    """
+        Returns {market_name: most recent snapshot price}, in one query.
+    """
+    # sqlite fills bare columns from the row that matched the (single) MAX()
+    query = PriceSnapshot.select(
+        PriceSnapshot.market_name,
+        PriceSnapshot.price,
+        fn.MAX(PriceSnapshot.timestamp)
+    ).where(
+        (PriceSnapshot.exchange == exchange) & PriceSnapshot.market_name.in_(list(set(market_names)))
+    ).group_by(PriceSnapshot.market_name).tuples()
+    return {market_name: price for market_name, price, _ in query}
+
+
+
+def average_prices(credential, by_schedule: bool):
+    """
+        Mean snapshot price for each group of this credential's fills (as grouped by
+        `_aggregate_fills`) since that group's first fill, in one query. Returns
+        {market_name: price}, or {(schedule_id, market_name): price} `by_schedule`.
+    """
+    # Snapshots are taken on a fixed interval so their plain mean approximates the
+    #   time-weighted average price.
+    group_by = [Fill.market_name]
+    if by_schedule:
+        group_by.insert(0, Fill.schedule)
+
+    first_fills = Fill.select(
+        *group_by,
+        fn.MIN(Fill.filled_at).alias("first_fill")
+    ).where(
+        Fill.credential == credential.id
+    ).group_by(*group_by).alias("first_fills")
+
+    keys = [first_fills.c.market_name]
+    if by_schedule:
+        keys.insert(0, first_fills.c.schedule_id)
+
+    query = PriceSnapshot.select(
+        *keys,
+        fn.AVG(PriceSnapshot.price)
+    ).join(
+        first_fills, on=(
+            (PriceSnapshot.market_name == first_fills.c.market_name) &
+            (PriceSnapshot.timestamp >= first_fills.c.first_fill)
+        )
+    ).where(
+        PriceSnapshot.exchange == credential.exchange
+    ).group_by(*keys).tuples()
+
+    if by_schedule:
+        return {(schedule_id, market_name): price for schedule_id, market_name, price in query}
+    return {market_name: price for market_name, price in query}
+
+
+
+class PositionStats(object):
+    """
+        Cost basis and performance for one group of fills (a schedule, or every fill in
+        a market for a credential). Realized P&L uses the average cost of all buys.
+    """
+    def __init__(self, row, last_price=None, average_price=None):
+        self.schedule_id = row.get("schedule")
+        self.market_name = row["market_name"]
+        self.num_fills = row["num_fills"]
+        self.buy_quantity = row["buy_quantity"] or 0.0
+        self.buy_notional = row["buy_notional"] or 0.0
+        self.buy_fees = row["buy_fees"] or 0.0
+        self.sell_quantity = row["sell_quantity"] or 0.0
+        self.sell_notional = row["sell_notional"] or 0.0
+        self.sell_fees = row["sell_fees"] or 0.0
+        self.first_fill = row["first_fill"]
+        self.first_price = row["first_price"]
+
+        # Fall back to the first fill's price before any snapshot has been recorded
+        self.last_price = last_price if last_price is not None else self.first_price
+        self.average_market_price = average_price
+
+        self.invested = self.buy_notional + self.buy_fees
+        self.position = self.buy_quantity - self.sell_quantity
+        self.average_entry_price = self.buy_notional / self.buy_quantity if self.buy_quantity else None
+
+        unit_cost = self.invested / self.buy_quantity if self.buy_quantity else 0.0
+        self.cost_basis = self.position * unit_cost
+        self.realized_pnl = self.sell_notional - self.sell_fees - self.sell_quantity * unit_cost
+        self.market_value = self.position * self.last_price if self.last_price else None
+        self.unrealized_pnl = self.market_value - self.cost_basis if self.market_value is not None else None
+
+        # What the same money would be worth had it all been invested at the first fill
+        self.lump_sum_value = None
+        if self.invested and self.first_price and self.last_price:
+            self.lump_sum_value = self.invested / self.first_price * self.last_price
+
+
+    @property
+    def days_active(self):
+        if not self.first_fill:
+            return 0
+        return (datetime.datetime.now() - self.first_fill).total_seconds() / 86400
+
+
+    @property
+    def return_pct(self):
+        if not self.cost_basis or self.unrealized_pnl is None:
+            return None
+        return self.unrealized_pnl / self.cost_basis * 100
+
+
+    @property
+    def vs_lump_sum_pct(self):
+        # Positive when DCA has done better than investing everything up front
+        if not self.lump_sum_value or self.market_value is None:
+            return None
+        return (self.market_value + self.sell_notional - self.lump_sum_value) / self.lump_sum_value * 100
+
+
+    @property
+    def vs_average_price_pct(self):
+        # Negative when we bought below the market's average price over the period
+        if not self.average_entry_price or not self.average_market_price:
+            return None
+        return (self.average_entry_price / self.average_market_price - 1) * 100
+
+
+    def to_dict(self):
+        data = dict(self.__dict__)
+        data.update({
+            "days_active": self.days_active,
+            "return_pct": self.return_pct,
+            "vs_lump_sum_pct": self.vs_lump_sum_pct,
+            "vs_average_price_pct": self.vs_average_price_pct,
+        })
+        return data
+
+
+
+def _aggregate_fills(credential_id, by_schedule: bool):
+    def buys(value):
+        return fn.SUM(Case(None, [(Fill.is_buy == True, value)], 0))
+
+    def sells(value):
+        return fn.SUM(Case(None, [(Fill.is_buy == False, value)], 0))
+
+    group_by = [Fill.market_name]
+    if by_schedule:
+        group_by.insert(0, Fill.schedule)
+
+    # sqlite fills bare columns from the row that matched the (single) MIN(), which
+    #   gives us the first fill's price without a second query.
+    return Fill.select(
+        *group_by,
+        fn.COUNT(Fill.id).alias("num_fills"),
+        buys(Fill.quantity).alias("buy_quantity"),
+        buys(Fill.notional).alias("buy_notional"),
+        buys(Fill.fee).alias("buy_fees"),
+        sells(Fill.quantity).alias("sell_quantity"),
+        sells(Fill.notional).alias("sell_notional"),
+        sells(Fill.fee).alias("sell_fees"),
+        fn.MIN(Fill.filled_at).alias("first_fill"),
+        (Fill.notional / Fill.quantity).alias("first_price"),
+    ).where(
+        Fill.credential == credential_id
+    ).group_by(*group_by).dicts()
+
+
+
+def credential_performance(credential):
+    """
+        Returns `{"schedules": {schedule_id: PositionStats}, "markets": [PositionStats]}`
+        for every fill on this credential; "markets" also includes manual orders.
+    """
+    schedule_rows = list(_aggregate_fills(credential.id, by_schedule=True))
+    market_rows = list(_aggregate_fills(credential.id, by_schedule=False))
+
+    prices = latest_prices(credential.exchange, [row["market_name"] for row in market_rows])
+    schedule_averages = average_prices(credential, by_schedule=True)
+    market_averages = average_prices(credential, by_schedule=False)
+
+    def stats(row, average_price):
+        first_fill = row["first_fill"]
+        if isinstance(first_fill, str):
+            # Aggregates come back as raw sqlite values
+            row["first_fill"] = Fill.filled_at.python_value(first_fill)
+
+        return PositionStats(row, last_price=prices.get(row["market_name"]), average_price=average_price)
+
+    return {
+        "schedules": {
+            row["schedule"]: stats(row, schedule_averages.get((row["schedule"], row["market_name"])))
+            for row in schedule_rows if row["schedule"]
+        },
+        "markets": [stats(row, market_averages.get(row["market_name"])) for row in market_rows],
+    }
@@ -1,9 +1,8 @@
-
 if __name__ == "__main__":
-    from server import app
-    from models import create_tables
+    from server import app, start_background_startup
 
-    # Creates sqlite DB tables if necessary
-    create_tables()
+    # Migrates the db and starts the event relay without holding up the server;
+    #   `/ready` reports when it's done
+    start_background_startup()
 
     app.run(port=61712)
@@ -0,0 +1,114 @@
+import datetime
+import logging
+import time
+
+from peewee import Cast, fn
+
+import analytics
+
+from models import db, ArchivedOrder, Order
+
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses an order never leaves; `pending` and `open` orders always stay in `Order`
+TERMINAL_STATUSES = (
+    Order.STATUS__COMPLETE,
+    Order.STATUS__CANCELLED,
+    Order.STATUS__REJECTED,
+    Order.STATUS__INSUFFICIENT_FUNDS,
+    Order.STATUS__MIN_ORDER_SIZE,
+)
+
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+
+# Each batch is its own short write transaction so the server and order placement
+#   are never blocked for long; we pause between batches to let them in.
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_BATCH_PAUSE = 0.05
+
+# Cap on batches per call; the rest waits for the daemon's next pass
+DEFAULT_MAX_BATCHES = 20
+
+SUMMARY_FIELDS = [
+    Order.id,
+    Order.schedule,
+    Order.credential,
+    Order.order_id,
+    Order.client_order_id,
+    Order.status,
+    Order.market_name,
+    Order.order_side,
+    Order.amount,
+    Order.amount_currency,
+    Order.created,
+    Order.updated,
+    Order.executed_amount,
+    Order.avg_execution_price,
+    Order.fee,
+    Order.allocation,
+]
+
+
+
+def _archivable(cutoff):
+    # sqlite hands out max(rowid) + 1 for new rows, so archiving the newest order would
+    #   let the next one reuse its id. Leave that one in place.
+    newest_id = Order.select(fn.MAX(Order.id)).scalar()
+    return (
+        (Order.id < newest_id) &
+        (Order.is_live == False) &
+        Order.status.in_(TERMINAL_STATUSES) &
+        (fn.COALESCE(Order.updated, Order.created) < cutoff)
+    )
+
+
+
+def _archive_batch(cutoff, batch_size):
+    # Take the write lock up front so another daemon can't archive the same rows between
+    #   our read and our write
+    with db.atomic(lock_type="IMMEDIATE"):
+        # Read `raw_data` as stored rather than parsing it only to re-encode it
+        rows = list(Order.select(
+            *SUMMARY_FIELDS,
+            Cast(Order.raw_data, "TEXT").alias("raw_json")
+        ).where(
+            _archivable(cutoff)
+        ).order_by(Order.id).limit(batch_size).dicts())
+        if not rows:
+            return 0
+
+        for row in rows:
+            row["compressed_raw_data"] = ArchivedOrder.compress(row.pop("raw_json") or "{}")
+
+        ArchivedOrder.insert_many(rows).execute()
+        Order.delete().where(Order.id.in_([row["id"] for row in rows])).execute()
+        return len(rows)
+
+
+
+def archive_orders(older_than_days: float = DEFAULT_ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE,
+                   max_batches: int = DEFAULT_MAX_BATCHES):
+    """
+        Moves terminal orders last touched more than `older_than_days` ago into
+        `ArchivedOrder`, `batch_size` rows per transaction. Returns the number of orders
+        archived; safe to call repeatedly and from several daemons at once.
+    """
+    # Fills are copied from `Order`, so make sure every executed order has one first
+    analytics.sync_fills()
+
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than_days)
+    archived = 0
+    for i in range(max_batches):
+        if i:
+            time.sleep(ARCHIVE_BATCH_PAUSE)
+        count = _archive_batch(cutoff, batch_size)
+        archived += count
+        if count < batch_size:
+            break
+
+    if archived:
+        logger.info(f"Archived {archived} orders")
+    return archived
+
@@ -0,0 +1,396 @@
+"""
+    Replays DCA schedules over historical OHLC candles using the same pricing and
+    quantization rules as live orders (`GeminiMarket`), e.g.:
+
+        python backtest.py btcusd_1m.csv --market BTCUSD --amount 10 25 50 \\
+            --repeat 1 4 12 --timescale "hour(s)" "day(s)"
+
+    Every combination of --amount/--repeat/--timescale is simulated against the same
+    loaded candles.
+"""
+import bisect
+import csv
+import datetime
+import itertools
+import time
+
+from array import array
+from decimal import Decimal
+
+from exchanges.gemini import GeminiMarket
+from models import DCASchedule, Order
+
+
+
+# Defaults for what an OHLC file can't tell us
+DEFAULT_FEE_RATE = 0.002            # Gemini API maker fee
+DEFAULT_SPREAD = 0.0002             # Assumed bid/ask spread around each candle's open
+DEFAULT_FILL_WINDOW = 60            # Candles a resting order waits for a fill
+
+
+
+class Candles(object):
+    """
+        Columnar OHLC data: parallel arrays of floats, timestamps in epoch seconds.
+    """
+    def __init__(self):
+        self.timestamps = array('d')
+        self.opens = array('d')
+        self.highs = array('d')
+        self.lows = array('d')
+        self.closes = array('d')
+
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+    @property
+    def resolution(self):
+        """
+            Seconds between candles if they're evenly spaced, otherwise None.
+        """
+        if len(self) < 2:
+            return None
+        step = self.timestamps[1] - self.timestamps[0]
+        if self.timestamps[-1] - self.timestamps[0] != step * (len(self) - 1):
+            return None
+        return step
+
+
+    def index_at(self, timestamp):
+        # First candle at or after `timestamp`
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+
+
+def _parse_timestamp(value):
+    try:
+        timestamp = float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+    # Many exports use milliseconds
+    return timestamp / 1000 if timestamp > 1e11 else timestamp
+
+
+
+def load_candles(source):
+    """
+        Reads a CSV with a header row containing a timestamp column (`timestamp`,
+        `time`, or `date`; epoch seconds, epoch ms, or ISO 8601) plus `open`, `high`,
+        `low`, and `close`. `source` is a path or a text file object.
+    """
+    if isinstance(source, str):
+        with open(source, newline='') as f:
+            return load_candles(f)
+
+    reader = csv.reader(source)
+    header = [column.strip().lower() for column in next(reader)]
+    time_column = next(i for i, column in enumerate(header) if column in ("timestamp", "time", "date"))
+    open_column, high_column, low_column, close_column = [header.index(c) for c in ("open", "high", "low", "close")]
+
+    candles = Candles()
+    for row in reader:
+        if row:
+            candles.timestamps.append(_parse_timestamp(row[time_column]))
+            candles.opens.append(float(row[open_column]))
+            candles.highs.append(float(row[high_column]))
+            candles.lows.append(float(row[low_column]))
+            candles.closes.append(float(row[close_column]))
+
+    # Exports are frequently newest-first
+    timestamps = candles.timestamps
+    if any(timestamps[i] > timestamps[i + 1] for i in range(len(timestamps) - 1)):
+        order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+        for column in ("timestamps", "opens", "highs", "lows", "closes"):
+            values = getattr(candles, column)
+            setattr(candles, column, array('d', (values[i] for i in order)))
+    return candles
+
+
+
+class BacktestResult(object):
+    def __init__(self, schedule):
+        self.market_name = schedule.market_name
+        self.order_side = schedule.order_side
+        self.amount = schedule.amount
+        self.amount_currency = schedule.amount_currency
+        self.repeat_duration = schedule.repeat_duration
+        self.repeat_timescale = schedule.repeat_timescale
+
+        self.num_orders = 0
+        self.num_filled = 0
+        self.num_unfilled = 0
+        self.rejects = {}               # Order.STATUS__* -> count
+        self.quantity = 0.0             # base currency bought (or sold)
+        self.notional = 0.0             # quote currency spent (or received), before fees
+        self.fees = 0.0
+        self.last_price = None
+
+
+    @property
+    def num_rejected(self):
+        return sum(self.rejects.values())
+
+
+    @property
+    def average_price(self):
+        return self.notional / self.quantity if self.quantity else None
+
+
+    @property
+    def cost_basis(self):
+        return self.notional + self.fees
+
+
+    @property
+    def market_value(self):
+        return self.quantity * self.last_price if self.last_price is not None else None
+
+
+    @property
+    def pnl(self):
+        if self.market_value is None:
+            return None
+        if self.order_side == "buy":
+            return self.market_value - self.cost_basis
+        return self.notional - self.fees - self.market_value
+
+
+    @property
+    def pnl_pct(self):
+        if self.pnl is None or not self.cost_basis:
+            return None
+        return self.pnl / self.cost_basis * 100
+
+
+    def to_dict(self):
+        return {
+            "market_name": self.market_name,
+            "order_side": self.order_side,
+            "amount": self.amount,
+            "amount_currency": self.amount_currency,
+            "repeat_duration": self.repeat_duration,
+            "repeat_timescale": self.repeat_timescale,
+            "num_orders": self.num_orders,
+            "num_filled": self.num_filled,
+            "num_unfilled": self.num_unfilled,
+            "rejects": self.rejects,
+            "quantity": self.quantity,
+            "average_price": self.average_price,
+            "fees": self.fees,
+            "cost_basis": self.cost_basis,
+            "market_value": self.market_value,
+            "pnl": self.pnl,
+            "pnl_pct": self.pnl_pct,
+        }
+
+
+
+class Backtester(object):
+    """
+        Simulates schedules on one market. Each order is priced at the quantized
+        midmarket of a synthetic bid/ask around the candle's open, rejected the way
+        Gemini would (below min order size, or maker-or-cancel that would take), and
+        filled at its limit price if a later candle trades through it within
+        `fill_window` candles.
+
+        Prices depend only on the candle, so they're computed once and shared by every
+        schedule replayed on this instance.
+    """
+    def __init__(self, candles, market, fee_rate=DEFAULT_FEE_RATE, spread=DEFAULT_SPREAD, fill_window=DEFAULT_FILL_WINDOW):
+        self.candles = candles
+        self.market = market
+        self.fee_rate = fee_rate
+        self.spread = spread
+        self.fill_window = fill_window
+        self._prices = {}
+
+
+    def quote(self, index):
+        """
+            Returns `(bid, ask, limit_price)` as Decimals for an order placed at candle
+            `index`.
+        """
+        quote = self._prices.get(index)
+        if quote is None:
+            open_price = self.candles.opens[index]
+            bid = Decimal(repr(open_price * (1 - self.spread / 2)))
+            ask = Decimal(repr(open_price * (1 + self.spread / 2)))
+            quote = (bid, ask, self.market.midmarket_price(bid, ask))
+            self._prices[index] = quote
+        return quote
+
+
+    def fire_indexes(self, schedule, start=None):
+        candles = self.candles
+        if not len(candles):
+            return range(0)
+
+        start = candles.timestamps[0] if start is None else start
+        interval = schedule.repeat_interval.total_seconds()
+
+        # Evenly spaced candles let us stride straight to each fire
+        resolution = candles.resolution
+        if resolution and interval % resolution == 0:
+            first = candles.index_at(start)
+            return range(first, len(candles), int(interval // resolution))
+
+        indexes = []
+        timestamp = start
+        end = candles.timestamps[-1]
+        while timestamp <= end:
+            index = candles.index_at(timestamp)
+            if index < len(candles):
+                indexes.append(index)
+            timestamp += interval
+        return indexes
+
+
+    def run(self, schedule, start=None):
+        result = BacktestResult(schedule)
+        candles = self.candles
+        market = self.market
+        lows, highs = candles.lows, candles.highs
+        is_buy = schedule.order_side == "buy"
+        amount = Decimal(str(schedule.amount))
+        num_candles = len(candles)
+
+        for index in self.fire_indexes(schedule, start=start):
+            result.num_orders += 1
+            bid, ask, price = self.quote(index)
+
+            # maker-or-cancel; see `GeminiApiConnection.new_order`
+            if (is_buy and price >= ask) or (not is_buy and price <= bid):
+                result.rejects[Order.STATUS__REJECTED] = result.rejects.get(Order.STATUS__REJECTED, 0) + 1
+                continue
+
+            quantity = market.order_quantity(amount, price)
+            if quantity < market.base_min_size:
+                result.rejects[Order.STATUS__MIN_ORDER_SIZE] = result.rejects.get(Order.STATUS__MIN_ORDER_SIZE, 0) + 1
+                continue
+
+            limit = float(price)
+            filled = False
+            for j in range(index, min(index + self.fill_window, num_candles)):
+                if (lows[j] <= limit) if is_buy else (highs[j] >= limit):
+                    filled = True
+                    break
+
+            if not filled:
+                result.num_unfilled += 1
+                continue
+
+            notional = float(quantity) * limit
+            result.num_filled += 1
+            result.quantity += float(quantity)
+            result.notional += notional
+            result.fees += notional * self.fee_rate
+
+        if num_candles:
+            result.last_price = candles.closes[-1]
+        return result
+
+
+    def sweep(self, schedules, start=None):
+        return [self.run(schedule, start=start) for schedule in schedules]
+
+
+
+def schedule_grid(market_name, order_side, amount_currency, amounts, repeat_durations, repeat_timescales):
+    """
+        Unsaved `DCASchedule`s for every parameter combination.
+    """
+    return [
+        DCASchedule(
+            market_name=market_name,
+            order_side=order_side,
+            amount=Decimal(str(amount)),
+            amount_currency=amount_currency,
+            repeat_duration=repeat_duration,
+            repeat_timescale=repeat_timescale,
+        )
+        for amount, repeat_duration, repeat_timescale in itertools.product(amounts, repeat_durations, repeat_timescales)
+    ]
+
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from peewee import fn
+    from models import create_tables, db, APICredential, SymbolDetails
+
+    parser = argparse.ArgumentParser(
+        description="""
+            Bonsai DCA - backtest schedules over historical candles
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    parser.add_argument('candles', help="OHLC candle CSV")
+    parser.add_argument('--schedule-id', type=int, default=None, dest="schedule_id", help="Replay an existing schedule instead of a parameter grid")
+    parser.add_argument('--market', default="BTCUSD", dest="market_name")
+    parser.add_argument('--side', default="buy", dest="order_side")
+    parser.add_argument('--amount', nargs="+", default=["10"], dest="amounts")
+    parser.add_argument('--amount-currency', default="USD", dest="amount_currency")
+    parser.add_argument('--repeat', type=int, nargs="+", default=[1], dest="repeat_durations")
+    parser.add_argument('--timescale', nargs="+", default=[DCASchedule.DAYS], dest="repeat_timescales",
+                        help=f"Any of '{DCASchedule.DAYS}', '{DCASchedule.HOURS}', '{DCASchedule.MINUTES}'")
+    parser.add_argument('--fee-rate', type=float, default=DEFAULT_FEE_RATE, dest="fee_rate")
+    parser.add_argument('--spread', type=float, default=DEFAULT_SPREAD, help="Fractional bid/ask spread around each candle's open")
+    parser.add_argument('--fill-window', type=int, default=DEFAULT_FILL_WINDOW, dest="fill_window", help="Candles to wait for a fill")
+    parser.add_argument('--min-order-size', default=None, dest="min_order_size", help="Override the market's symbol details")
+    parser.add_argument('--tick-size', default=None, dest="tick_size")
+    parser.add_argument('--quote-increment', default=None, dest="quote_increment")
+
+    args = parser.parse_args()
+
+    create_tables()
+    with db.connection_context():
+        if args.schedule_id:
+            schedules = [DCASchedule.get_by_id(args.schedule_id)]
+        else:
+            schedules = schedule_grid(
+                args.market_name, args.order_side.lower(), args.amount_currency,
+                args.amounts, args.repeat_durations, args.repeat_timescales
+            )
+        market_name = schedules[0].market_name
+
+        # Use the symbol details the live daemon last cached for this market
+        cached = SymbolDetails.get_or_none(
+            (SymbolDetails.exchange == APICredential.EXCHANGE__GEMINI) &
+            (fn.LOWER(SymbolDetails.market_name) == market_name.lower())
+        )
+        symbol_details = dict(cached.raw_data) if cached else {}
+
+    for key, value in (("min_order_size", args.min_order_size), ("tick_size", args.tick_size), ("quote_increment", args.quote_increment)):
+        if value is not None:
+            symbol_details[key] = value
+    if not all(symbol_details.get(key) for key in ("min_order_size", "tick_size", "quote_increment")):
+        parser.error(f"No cached symbol details for {market_name}; pass --min-order-size, --tick-size, and --quote-increment")
+    symbol_details.setdefault("quote_currency", schedules[0].amount_currency)
+    symbol_details.setdefault("base_currency", market_name[:-len(symbol_details["quote_currency"])])
+
+    start = time.perf_counter()
+    candles = load_candles(args.candles)
+    load_time = time.perf_counter() - start
+
+    market = GeminiMarket(market_name, schedules[0].amount_currency, schedules[0].order_side, symbol_details)
+    backtester = Backtester(candles, market, fee_rate=args.fee_rate, spread=args.spread, fill_window=args.fill_window)
+
+    start = time.perf_counter()
+    results = backtester.sweep(schedules)
+    run_time = time.perf_counter() - start
+
+    print(f"{len(candles)} candles loaded in {load_time:.2f}s; {len(results)} schedule(s) replayed in {run_time:.2f}s")
+    print()
+    print(f"{'amount':>10} {'every':>12} {'orders':>8} {'filled':>8} {'unfilled':>8} {'rejected':>8} {'cost basis':>14} {'avg price':>12} {'value':>14} {'P&L %':>8}")
+    for result in results:
+        average_price = f"{result.average_price:.2f}" if result.average_price else "-"
+        market_value = f"{result.market_value:.2f}" if result.market_value is not None else "-"
+        pnl_pct = f"{result.pnl_pct:.2f}" if result.pnl_pct is not None else "-"
+        print(f"{str(result.amount) + ' ' + result.amount_currency:>10} {str(result.repeat_duration) + ' ' + result.repeat_timescale:>12} "
+              f"{result.num_orders:>8} {result.num_filled:>8} {result.num_unfilled:>8} {result.num_rejected:>8} "
+              f"{result.cost_basis:>14.2f} {average_price:>12} {market_value:>14} {pnl_pct:>8}")
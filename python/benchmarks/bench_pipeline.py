@@ -0,0 +1,213 @@
+"""
+    Offline benchmark of the schedule -> order pipeline against a local Gemini stub.
+
+    Every schedule is made due at the same instant; the report covers how quickly the
+    daemon works through them and how expensive reconciling the resulting live orders
+    is. Run from the python/ directory:
+
+        python -m benchmarks.bench_pipeline --schedules 1000 --credentials 10 --latency 0.05
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+from decimal import Decimal
+
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+
+class WriteTimer(object):
+    """
+        Wraps `db.execute_sql` to total up time spent in sqlite writes.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+        self._execute_sql = db.execute_sql
+        db.execute_sql = self.execute_sql
+
+
+    def execute_sql(self, sql, *args, **kwargs):
+        if not sql.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE")):
+            return self._execute_sql(sql, *args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return self._execute_sql(sql, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.total += elapsed
+                self.count += 1
+
+
+
+def run(args):
+    from benchmarks.gemini_stub import GeminiStubServer
+    from models import configure_database, create_tables, db, APICredential, DCASchedule, Order
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="bonsai_bench_"), "bench.db")
+    configure_database(db_path)
+    create_tables()
+
+    stub = GeminiStubServer(latency=args.latency, error_rate=args.error_rate).start()
+
+    from exchanges.gemini import GeminiApiConnection
+    GeminiApiConnection.set_base_url(stub.base_url)
+    if not args.rate_limit:
+        # The stub doesn't enforce Gemini's limits; measure the pipeline itself
+        GeminiApiConnection.public_rate_limiter = None
+        GeminiApiConnection.private_rate_limiter = None
+
+    import daemon
+    # Reconciliation is timed separately below. The daemon's first loop updates live
+    #   orders straight away, so stub that out for the placement phase too; otherwise
+    #   the seeded backlog is reconciled (and counted) while placing.
+    daemon.ORDER_UPDATE_INTERVAL = 3600
+    update_live_orders = daemon.update_live_orders
+    daemon.update_live_orders = lambda: None
+
+    credentials = [
+        APICredential.create(exchange=APICredential.EXCHANGE__GEMINI, client_key=f"bench-key-{i}", client_secret="secret")
+        for i in range(args.credentials)
+    ]
+
+    # Pre-existing backlog of resting orders to reconcile
+    with db.atomic():
+        for i in range(args.live_orders):
+            credential = credentials[i % len(credentials)]
+            status = stub.new_order({"symbol": "BTCUSD", "side": "buy", "price": "50000.00", "amount": "0.0002"})
+            Order.create(
+                credential=credential,
+                order_id=status["order_id"],
+                market_name="BTCUSD",
+                order_side="buy",
+                amount=Decimal("10"),
+                amount_currency="USD",
+                raw_data=status
+            )
+
+    # Every schedule becomes due at `fire_at`
+    fire_at = datetime.datetime.now() + datetime.timedelta(seconds=args.warmup)
+    rows = [
+        {
+            "credential": credentials[i % len(credentials)].id,
+            "market_name": "BTCUSD",
+            "order_side": "buy",
+            "amount": Decimal("10"),
+            "amount_currency": "USD",
+            "repeat_duration": 1,
+            "repeat_timescale": DCASchedule.DAYS,
+            "last_run": fire_at - datetime.timedelta(days=1),
+        }
+        for i in range(args.schedules)
+    ]
+    with db.atomic():
+        for start in range(0, len(rows), 500):
+            DCASchedule.insert_many(rows[start:start + 500]).execute()
+
+    write_timer = WriteTimer(db)
+    stub.calls.clear()
+
+    threading.Thread(target=daemon.timer_thread, kwargs={"max_workers": args.workers, "coalesce_window": args.coalesce_window}, daemon=True).start()
+
+    # Reconciling happens on the stubbed-out update tick, so an intent left pending by an
+    #   injected error stays pending; once every schedule has been claimed and released
+    #   those are counted as failures rather than waited for
+    seeded_last_run = fire_at - datetime.timedelta(days=1)
+    deadline = time.time() + args.warmup + args.timeout
+    while time.time() < deadline:
+        # Intents are journaled as pending before submission; count submitted orders
+        placed = Order.select().where(Order.schedule.is_null(False) & (Order.status != Order.STATUS__PENDING)).count()
+        if placed >= args.schedules:
+            break
+        unsettled = DCASchedule.select().where(
+            (DCASchedule.last_run == seeded_last_run) | DCASchedule.lease_owner.is_null(False)
+        ).count()
+        if not unsettled and time.time() > fire_at.timestamp():
+            break
+        time.sleep(0.1)
+    pending = Order.select().where(Order.schedule.is_null(False) & (Order.status == Order.STATUS__PENDING)).count()
+
+    scheduled_orders = list(Order.select(Order.created, Order.updated).where(
+        Order.schedule.is_null(False) & (Order.status != Order.STATUS__PENDING)
+    ).tuples())
+    # Coalesced schedules fire up to `coalesce_window` early; those are reported on their
+    #   own rather than as negative lags
+    lags = [(updated - fire_at).total_seconds() for (created, updated) in scheduled_orders if created >= fire_at]
+    early = [(fire_at - created).total_seconds() for (created, updated) in scheduled_orders if created < fire_at]
+    placement_calls = sum(stub.calls.values())
+    placement_calls_by_endpoint = dict(stub.calls)
+    placement_writes = (write_timer.count, write_timer.total)
+
+    # Reconcile every live order once
+    daemon.update_live_orders = update_live_orders
+    live_before = Order.select().where(Order.is_live == True).count()
+    stub.calls.clear()
+    start = time.perf_counter()
+    daemon.update_live_orders()
+    reconcile_time = time.perf_counter() - start
+    live_after = Order.select().where(Order.is_live == True).count()
+
+    print(f"schedules: {args.schedules}  credentials: {args.credentials}  workers: {args.workers}  "
+          f"latency: {args.latency}s  error rate: {args.error_rate}  coalesce window: {args.coalesce_window}")
+    print()
+    print(f"orders placed:        {len(scheduled_orders)} / {args.schedules}")
+    if len(scheduled_orders) < args.schedules:
+        print(f"failed:               {args.schedules - len(scheduled_orders)}  (left pending: {pending})")
+    if scheduled_orders:
+        # Wall clock from the first schedule firing to the last order being recorded
+        first_fired = min(created for (created, updated) in scheduled_orders)
+        last_recorded = max(updated for (created, updated) in scheduled_orders)
+        duration = max((last_recorded - first_fired).total_seconds(), 1e-3)
+        print(f"throughput:           {len(scheduled_orders) / duration:.1f} orders/sec")
+    if lags:
+        print(f"fire lag p50:         {percentile(lags, 50) * 1000:.1f} ms")
+        print(f"fire lag p99:         {percentile(lags, 99) * 1000:.1f} ms")
+        print(f"fire lag max:         {max(lags) * 1000:.1f} ms")
+    if early:
+        print(f"fired early:          {len(early)}  (up to {max(early) * 1000:.1f} ms early)")
+    if scheduled_orders:
+        print(f"api calls / order:    {placement_calls / len(scheduled_orders):.2f}  {placement_calls_by_endpoint}")
+    print(f"sqlite writes:        {placement_writes[0]} in {placement_writes[1] * 1000:.1f} ms")
+    print()
+    print(f"reconciled:           {live_before} live orders in {reconcile_time * 1000:.1f} ms")
+    print(f"reconcile api calls:  {sum(stub.calls.values())}  {dict(stub.calls)}")
+    print(f"still live:           {live_after}")
+
+    stub.stop()
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+            Bonsai DCA - offline schedule -> order pipeline benchmark
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--schedules', type=int, default=500, help="Number of schedules that come due at once")
+    parser.add_argument('--credentials', type=int, default=5, help="Number of API credentials to spread them across")
+    parser.add_argument('--live-orders', type=int, default=0, dest="live_orders", help="Resting orders to pre-seed for reconciliation")
+    parser.add_argument('--workers', type=int, default=8, help="Daemon worker pool size")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds of latency added to every stub response")
+    parser.add_argument('--error-rate', type=float, default=0.0, dest="error_rate", help="Fraction of stub responses that fail with a 503")
+    parser.add_argument('--rate-limit', action="store_true", default=False, dest="rate_limit", help="Keep Gemini's client-side rate limits in place")
+    parser.add_argument('--coalesce-window', type=float, default=None, dest="coalesce_window", help="Combine same-market schedules into aggregated orders")
+    parser.add_argument('--warmup', type=float, default=2.0, help="Seconds before the schedules come due")
+    parser.add_argument('--timeout', type=float, default=300.0, help="Give up waiting for orders after this many seconds")
+
+    run(parser.parse_args())
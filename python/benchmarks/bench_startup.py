@@ -0,0 +1,148 @@
+"""
+    Cold start benchmark for the server and daemon entry points.
+
+    Imports each module in a fresh interpreter under `python -X importtime` and reports
+    the total import time, the slowest imports, and any module that should only be
+    loaded on first use but was imported eagerly. Then launches `server.py` and times
+    how long it takes to first answer and to report `/ready`. Exits non-zero if any
+    budget is exceeded. Run from the python/ directory:
+
+        python -m benchmarks.bench_startup --import-budget-ms 250 --ready-budget-ms 3000
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+
+
+# Only needed once an order is placed, a feature is switched on, or the db is migrated;
+#   importing any of these at module load is a regression. (ssl isn't listed: Flask
+#   loads it via http.client.)
+DEFERRED_MODULES = [
+    "requests",
+    "urllib3",
+    "websocket",
+    "exchanges.gemini",
+    "exchanges.session",
+    "migrations",
+    "playhouse.migrate",
+    "backtest",
+    "dateutil",
+]
+
+# Entry point -> modules it mustn't import at load. The daemon runs as its own process
+#   and has no use for the web stack.
+ENTRY_POINTS = {
+    "server": DEFERRED_MODULES,
+    "daemon": DEFERRED_MODULES + ["flask", "werkzeug", "http.server"],
+}
+
+SERVER_URL = "http://127.0.0.1:61712"
+
+
+
+def measure_imports(module, env):
+    """
+        Returns (total microseconds, {name: (self us, cumulative us)}) for importing
+        `module` in a fresh interpreter.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, capture_output=True, text=True, check=True
+    )
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return (imports[module][1], imports)
+
+
+
+def measure_ready(env, timeout):
+    """
+        Launches the server and returns (seconds to first response, seconds to ready).
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "server.py", "--log-level", "WARNING"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    first_response = None
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"{SERVER_URL}/ready", timeout=1):
+                    ready = time.perf_counter() - start
+                    return (first_response or ready, ready)
+            except urllib.error.HTTPError as e:
+                if first_response is None:
+                    first_response = time.perf_counter() - start
+                if e.code == 500:
+                    raise RuntimeError(f"Server failed to start: {e.read().decode()}")
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(0.01)
+        raise RuntimeError(f"Server wasn't ready within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+
+def run(args):
+    # Fresh data dir so the ready timing includes creating the db
+    env = dict(os.environ, HOME=tempfile.mkdtemp(prefix="bonsai_bench_"))
+    failures = []
+
+    for module, deferred in ENTRY_POINTS.items():
+        # Discard the first run; it pays for compiling bytecode
+        measure_imports(module, env)
+        totals = []
+        for i in range(args.repeat):
+            total_us, imports = measure_imports(module, env)
+            totals.append(total_us)
+        total_ms = min(totals) / 1000
+
+        print(f"import {module}: {total_ms:.1f}ms (best of {args.repeat})")
+        slowest = sorted(imports.items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+        for name, (self_us, cumulative_us) in slowest:
+            print(f"    {self_us / 1000:7.1f}ms self  {cumulative_us / 1000:7.1f}ms cumulative  {name}")
+
+        if total_ms > args.import_budget_ms:
+            failures.append(f"import {module} took {total_ms:.1f}ms (budget {args.import_budget_ms}ms)")
+        eager = [name for name in deferred if name in imports]
+        if eager:
+            failures.append(f"import {module} eagerly loaded: {', '.join(eager)}")
+
+    first_response, ready = measure_ready(env, timeout=args.timeout)
+    print(f"server: first response {first_response * 1000:.0f}ms, ready {ready * 1000:.0f}ms")
+    if ready * 1000 > args.ready_budget_ms:
+        failures.append(f"server took {ready * 1000:.0f}ms to be ready (budget {args.ready_budget_ms}ms)")
+
+    for failure in failures:
+        print(f"OVER BUDGET: {failure}")
+    return 1 if failures else 0
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bonsai DCA - cold start benchmark")
+    parser.add_argument('--import-budget-ms', type=float, default=250, dest="import_budget_ms",
+                        help="Max time to import each entry point")
+    parser.add_argument('--ready-budget-ms', type=float, default=3000, dest="ready_budget_ms",
+                        help="Max time from launching the server until /ready succeeds")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Import each entry point this many times and keep the best")
+    parser.add_argument('--top', type=int, default=10,
+                        help="Number of slowest imports to list")
+    parser.add_argument('--timeout', type=float, default=30,
+                        help="Give up waiting for the server after this many seconds")
+
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,181 @@
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+class GeminiStubServer(object):
+    """
+        Local stand-in for the parts of the Gemini REST API that the order pipeline
+        uses. Signatures aren't checked; authenticated payloads are just decoded.
+
+        `latency` seconds are added to every response and `error_rate` of requests
+        fail with a 503. Orders rest for `fill_after` seconds and then fill completely.
+    """
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, fill_after: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fill_after = fill_after
+
+        self.calls = Counter()
+        self.orders = {}    # order_id -> (created, order status)
+        self._order_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/v1"
+
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self, None)
+
+            def do_POST(self):
+                payload = json.loads(base64.b64decode(self.headers["X-GEMINI-PAYLOAD"]))
+                stub.handle(self, payload)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+
+
+    def _send(self, handler, status_code, data):
+        body = json.dumps(data).encode()
+        handler.send_response(status_code)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+    def handle(self, handler, payload):
+        path = handler.path.split("?")[0]
+
+        # Count per endpoint, not per market
+        endpoint = path
+        for prefix in ("/v1/symbols/details/", "/v1/book/"):
+            if path.startswith(prefix):
+                endpoint = prefix.rstrip("/")
+        with self._lock:
+            self.calls[endpoint] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            return self._send(handler, 503, {"result": "error", "reason": "Maintenance"})
+
+        if path.startswith("/v1/symbols/details/"):
+            market = path.rsplit("/", 1)[-1]
+            return self._send(handler, 200, {
+                "symbol": market.upper(),
+                "base_currency": market.upper()[:3],
+                "quote_currency": market.upper()[3:],
+                "tick_size": 1e-08,
+                "quote_increment": 0.01,
+                "min_order_size": "0.00001",
+                "status": "open",
+            })
+
+        if path.startswith("/v1/book/"):
+            return self._send(handler, 200, {
+                "bids": [{"price": "49999.99", "amount": "1.0", "timestamp": str(int(time.time()))}],
+                "asks": [{"price": "50000.01", "amount": "1.0", "timestamp": str(int(time.time()))}],
+            })
+
+        if path == "/v1/order/new":
+            return self._send(handler, 200, self.new_order(payload))
+
+        if path == "/v1/order/status":
+            if "client_order_id" in payload:
+                with self._lock:
+                    orders = [o for o in self.orders.values() if o[1].get("client_order_id") == payload["client_order_id"]]
+                return self._send(handler, 200, [self.order_status(*o) for o in orders])
+
+            with self._lock:
+                order = self.orders.get(payload["order_id"])
+            if not order:
+                return self._send(handler, 400, {"result": "error", "reason": "OrderNotFound"})
+            return self._send(handler, 200, self.order_status(*order))
+
+        if path == "/v1/orders":
+            with self._lock:
+                orders = list(self.orders.values())
+            statuses = [self.order_status(*o) for o in orders]
+            return self._send(handler, 200, [s for s in statuses if s["is_live"]])
+
+        if path == "/v1/mytrades":
+            with self._lock:
+                orders = list(self.orders.values())
+            trades = []
+            for created, status in orders:
+                status = self.order_status(created, status)
+                if not status["is_live"] and status["symbol"] == payload["symbol"].lower():
+                    trades.append({
+                        "order_id": status["order_id"],
+                        "price": status["price"],
+                        "amount": status["original_amount"],
+                        "fee_amount": "0.0",
+                        "fee_currency": "USD",
+                        "timestamp": int(created),
+                    })
+            return self._send(handler, 200, trades)
+
+        return self._send(handler, 404, {"result": "error", "reason": "EndpointNotFound"})
+
+
+    def new_order(self, payload):
+        order_id = str(next(self._order_ids))
+        status = {
+            "order_id": order_id,
+            "symbol": payload["symbol"].lower(),
+            "side": payload["side"],
+            "price": payload["price"],
+            "original_amount": payload["amount"],
+            "executed_amount": "0",
+            "remaining_amount": payload["amount"],
+            "avg_execution_price": "0.00",
+            "is_live": True,
+            "is_cancelled": False,
+        }
+        if payload.get("client_order_id"):
+            status["client_order_id"] = payload["client_order_id"]
+        with self._lock:
+            self.orders[order_id] = (time.time(), status)
+        return status
+
+
+    def order_status(self, created, status):
+        if time.time() - created < self.fill_after:
+            return status
+
+        status = dict(status)
+        status.update({
+            "executed_amount": status["original_amount"],
+            "remaining_amount": "0",
+            "avg_execution_price": status["price"],
+            "is_live": False,
+        })
+        return status
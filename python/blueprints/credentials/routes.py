@@ -1,6 +1,11 @@
-from flask import Blueprint, jsonify, render_template, request, redirect, url_for
+from flask import Blueprint, abort, jsonify, render_template, request, redirect, url_for
 
+import analytics
+import taxlots
+
+from exchanges.base import forget_exchange
 from models import APICredential, DCASchedule, Order
+from serializers import csv_response, json_response, ndjson_response
 
 
 
@@ -33,20 +38,29 @@ def view_credential(credential_id):
     if request.method == 'POST':
         command = request.form['command']
         if command == 'DELETE':
+            forget_exchange(credential.id)
             credential.delete_instance()
             return redirect(url_for('home'))
 
-    recent_orders = Order.select(
+    # Evaluate both up front so the template can't trigger lazy per-row queries
+    schedules = list(credential.schedules)
+    recent_orders = list(Order.select_summary(
     ).where(
     	Order.credential == credential
 	).order_by(
 		Order.created.desc()
-	).limit(10)
+	).limit(10))
+
+    performance = analytics.credential_performance(credential)
 
     return render_template(
         'credentials/view_credential.html',
         credential=credential,
+        schedules=schedules,
         recent_orders=recent_orders,
+        schedule_performance=performance["schedules"],
+        market_performance=performance["markets"],
+        LOT_METHODS=taxlots.METHODS,
         STATUS__OPEN=Order.STATUS__OPEN,
         STATUS__INSUFFICIENT_FUNDS=Order.STATUS__INSUFFICIENT_FUNDS,
         STATUS__CANCELLED=Order.STATUS__CANCELLED,
@@ -54,3 +68,40 @@ def view_credential(credential_id):
         STATUS__COMPLETE=Order.STATUS__COMPLETE
     )
 
+
+
+
+@credentials_routes.route("/<credential_id>/performance")
+def credential_performance(credential_id):
+    credential = APICredential.get(id=credential_id)
+    performance = analytics.credential_performance(credential)
+    return json_response({
+        "schedules": {str(schedule_id): stats.to_dict() for schedule_id, stats in performance["schedules"].items()},
+        "markets": [stats.to_dict() for stats in performance["markets"]],
+    })
+
+
+
+@credentials_routes.route("/<credential_id>/tax_lots.<fmt>")
+def tax_lots(credential_id, fmt):
+    """
+        Streams realized gains lot by lot as CSV or NDJSON; see `taxlots.tax_lot_rows`.
+        Query params: `method` (fifo, lifo, hifo), `year`, and `open=1` to include the
+        lots still held.
+    """
+    credential = APICredential.get(id=credential_id)
+    method = request.args.get("method", taxlots.FIFO).lower()
+    if method not in taxlots.METHODS:
+        return jsonify({"error": f"method must be one of {', '.join(taxlots.METHODS)}"}), 400
+    year = request.args.get("year", type=int)
+
+    # Pick up anything filled since the daemon's last sync
+    analytics.sync_fills()
+
+    rows = taxlots.tax_lot_rows(credential.id, method, year=year, include_open=bool(request.args.get("open", type=int)))
+    filename = f"tax_lots_{credential.exchange}_{method}{'_' + str(year) if year else ''}.{fmt}"
+    if fmt == "csv":
+        return csv_response(taxlots.HEADER, rows, filename)
+    elif fmt == "ndjson":
+        return ndjson_response(taxlots.HEADER, rows, filename)
+    abort(404)
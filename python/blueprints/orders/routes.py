@@ -1,9 +1,13 @@
 from decimal import Decimal
-from flask import (Blueprint, jsonify, render_template, request, redirect,
+from flask import (Blueprint, abort, jsonify, render_template, request, redirect,
     url_for)
+from peewee import SQL
 
-from exchanges.gemini import GeminiExchange, GeminiRequestException
-from models import APICredential, DCASchedule, Order
+import events
+
+from exchanges.base import OrderSubmissionPending, get_exchange
+from models import iterate_query, APICredential, ArchivedOrder, DCASchedule, Order
+from serializers import csv_response, json_response, ndjson_response
 
 
 
@@ -13,20 +17,83 @@ orders_routes = Blueprint('orders', __name__, template_folder='_templates')
 @orders_routes.route("/<order_id>", defaults={"order_id": ""})
 @orders_routes.route("/<order_id>")
 def view_order(order_id):
-    order = Order.get(id=order_id)
+    order = Order.select(Order, APICredential).join(APICredential).where(Order.id == order_id).get_or_none()
+    if order is None:
+        # Old terminal orders have been moved to the archive; see `archive.archive_orders`
+        order = ArchivedOrder.select(ArchivedOrder, APICredential).join(APICredential).where(ArchivedOrder.id == order_id).get()
     return render_template('orders/view_order.html', order=order, credential=order.credential)
 
 
 
 @orders_routes.route('/recent')
 def recent_orders():
+    """
+        Newest orders first. Pass the last `id` received as `?before=<id>` to page
+        back through older orders.
+    """
+    before = request.args.get("before", type=int)
+    limit = max(1, min(request.args.get("limit", default=10, type=int), 100))
+
+    # Join the credential so reading its exchange doesn't cost a query per row
+    orders = Order.select_summary(
+        APICredential.exchange.alias("exchange")
+    ).join(APICredential).objects()
+    if before:
+        orders = orders.where(Order.id < before)
+
     data = []
-    for order in Order.select().order_by(Order.created.desc()).limit(10):
+    for order in orders.order_by(Order.id.desc()).limit(limit):
         entry = order.to_json()
-        entry["exchange"] = order.credential.exchange
+        entry["exchange"] = order.exchange
         data.append(entry)
 
-    return jsonify(data)
+    return json_response(data)
+
+
+
+EXPORT_FIELDS = [
+    "id",
+    "credential",
+    "schedule",
+    "order_id",
+    "client_order_id",
+    "status",
+    "market_name",
+    "order_side",
+    "amount",
+    "amount_currency",
+    "executed_amount",
+    "avg_execution_price",
+    "fee",
+    "allocation",
+    "created",
+    "updated",
+]
+
+
+
+@orders_routes.route("/export.<fmt>")
+def export_orders(fmt):
+    """
+        Streams every order, archived ones included, oldest first as CSV or NDJSON.
+        Optionally filtered to one `?credential_id=`.
+    """
+    credential_id = request.args.get("credential_id", type=int)
+
+    def summary(model):
+        query = model.select(*[getattr(model, name) for name in EXPORT_FIELDS])
+        if credential_id:
+            query = query.where(model.credential == credential_id)
+        return query
+
+    query = (summary(Order) + summary(ArchivedOrder)).order_by(SQL("id")).tuples()
+    header = [f"{name}_id" if name in ("credential", "schedule") else name for name in EXPORT_FIELDS]
+
+    if fmt == "csv":
+        return csv_response(header, iterate_query(query), "orders.csv")
+    elif fmt == "ndjson":
+        return ndjson_response(header, iterate_query(query), "orders.ndjson")
+    abort(404)
 
 
 
@@ -40,8 +107,15 @@ def manual_order(credential_id):
         amount = Decimal(request.form['amount'])
         amount_currency = request.form['amount_currency']
 
-        exchange = GeminiExchange(credential)
-        order = exchange.place_order(market_name, order_side, amount, amount_currency)
+        exchange = get_exchange(credential)
+        try:
+            order = exchange.place_order(market_name, order_side, amount, amount_currency)
+        except OrderSubmissionPending as e:
+            # The exchange may have accepted it, so retrying from here could buy twice;
+            #   the daemon reconciles the pending intent shortly instead
+            Order.release_pending(e.orders)
+            order = e.orders[0]
+        events.publish_order(order)
         return redirect(url_for('orders.view_order', order_id=order.id))
 
     return render_template('orders/manual_order.html', credential=credential)
@@ -0,0 +1 @@
+from .routes import schedules_routes
\ No newline at end of file
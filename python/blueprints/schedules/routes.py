@@ -0,0 +1,200 @@
+import csv
+import datetime
+import io
+import json
+
+from decimal import Decimal, InvalidOperation
+from flask import Blueprint, abort, render_template, request
+from peewee import chunked
+
+from models import db, iterate_query, APICredential, DCASchedule
+from scheduler import notify_schedules_changed
+from serializers import csv_response, json_response, ndjson_response
+
+
+
+schedules_routes = Blueprint('schedules', __name__, template_folder='_templates')
+
+# Columns read by import; `schedules/export` writes these too (plus a few read-only
+#   ones) so an export can be re-imported as is.
+IMPORT_FIELDS = [
+    "credential_id",
+    "market_name",
+    "order_side",
+    "amount",
+    "amount_currency",
+    "repeat_duration",
+    "repeat_timescale",
+    "catch_up_policy",
+]
+
+TIMESCALES = {
+    DCASchedule.DAYS: DCASchedule.DAYS, "day": DCASchedule.DAYS, "days": DCASchedule.DAYS,
+    DCASchedule.HOURS: DCASchedule.HOURS, "hour": DCASchedule.HOURS, "hours": DCASchedule.HOURS,
+    DCASchedule.MINUTES: DCASchedule.MINUTES, "minute": DCASchedule.MINUTES, "minutes": DCASchedule.MINUTES,
+}
+
+CATCH_UP_POLICIES = (DCASchedule.CATCH_UP__SKIP, DCASchedule.CATCH_UP__ONCE, DCASchedule.CATCH_UP__EACH)
+
+# Rows per INSERT; keeps each statement under sqlite's bound variable limit
+INSERT_BATCH_SIZE = 50
+
+
+
+def parse_schedule(data: dict, credential_ids, default_credential_id=None):
+    """
+        Validates one imported schedule and returns it as a row for `insert_many`.
+        Raises ValueError describing the first problem found.
+    """
+    def required(name):
+        value = data.get(name)
+        if value is None or str(value).strip() == "":
+            raise ValueError(f"{name} is required")
+        return str(value).strip()
+
+    credential_id = data.get("credential_id") or default_credential_id
+    try:
+        credential_id = int(credential_id)
+    except (TypeError, ValueError):
+        raise ValueError("credential_id is required")
+    if credential_id not in credential_ids:
+        raise ValueError(f"credential {credential_id} doesn't exist")
+
+    order_side = required("order_side").lower()
+    if order_side not in ("buy", "sell"):
+        raise ValueError(f"order_side must be buy or sell, not {order_side}")
+
+    try:
+        amount = Decimal(required("amount"))
+    except InvalidOperation:
+        raise ValueError(f"amount {data['amount']} isn't a number")
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError("amount must be positive")
+
+    try:
+        repeat_duration = int(required("repeat_duration"))
+    except ValueError:
+        raise ValueError(f"repeat_duration {data['repeat_duration']} isn't a whole number")
+    if repeat_duration <= 0:
+        raise ValueError("repeat_duration must be positive")
+
+    repeat_timescale = TIMESCALES.get(required("repeat_timescale").lower())
+    if not repeat_timescale:
+        raise ValueError(f"repeat_timescale must be one of {', '.join(TIMESCALES)}")
+
+    catch_up_policy = str(data.get("catch_up_policy") or DCASchedule.CATCH_UP__ONCE).strip().lower()
+    if catch_up_policy not in CATCH_UP_POLICIES:
+        raise ValueError(f"catch_up_policy must be one of {', '.join(CATCH_UP_POLICIES)}")
+
+    return {
+        "credential": credential_id,
+        "market_name": required("market_name").upper(),
+        "order_side": order_side,
+        "amount": amount,
+        "amount_currency": required("amount_currency").upper(),
+        "repeat_duration": repeat_duration,
+        "repeat_timescale": repeat_timescale,
+        "catch_up_policy": catch_up_policy,
+        "created": datetime.datetime.now(),
+    }
+
+
+
+def read_uploaded_schedules():
+    """
+        Returns the list of schedule dicts sent as a JSON body, or as an uploaded CSV or
+        JSON file (`file` field).
+    """
+    if request.is_json:
+        data = request.get_json()
+    else:
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            raise ValueError("Upload a CSV or JSON file")
+        if upload.filename.lower().endswith(".json"):
+            data = json.load(upload.stream)
+        else:
+            return list(csv.DictReader(io.TextIOWrapper(upload.stream, encoding="utf-8-sig")))
+
+    if isinstance(data, dict):
+        data = data.get("schedules")
+    if not isinstance(data, list) or not all(isinstance(entry, dict) for entry in data):
+        raise ValueError("Expected a list of schedules")
+    return data
+
+
+
+@schedules_routes.route("/import", methods=('GET', 'POST'))
+def import_schedules():
+    """
+        Bulk-creates schedules from a CSV/JSON upload or a JSON body. Every row is
+        validated before anything is written; if any row fails, nothing is imported
+        and each problem is returned. Rows may omit `credential_id` when it's passed
+        as a form or query parameter.
+    """
+    if request.method == 'GET':
+        return render_template(
+            'schedules/import_schedules.html',
+            credentials=APICredential.select().order_by(APICredential.exchange),
+            fields=IMPORT_FIELDS,
+        )
+
+    try:
+        entries = read_uploaded_schedules()
+    except ValueError as e:
+        return json_response({"created": 0, "errors": [{"row": None, "error": str(e)}]}), 400
+
+    credential_ids = set(credential_id for (credential_id,) in APICredential.select(APICredential.id).tuples())
+    default_credential_id = request.values.get("credential_id")
+
+    rows = []
+    errors = []
+    for i, entry in enumerate(entries, start=1):
+        try:
+            rows.append(parse_schedule(entry, credential_ids, default_credential_id))
+        except ValueError as e:
+            errors.append({"row": i, "error": str(e)})
+
+    if errors:
+        return json_response({"created": 0, "errors": errors}), 400
+
+    with db.atomic():
+        for batch in chunked(rows, INSERT_BATCH_SIZE):
+            DCASchedule.insert_many(batch).execute()
+
+    if rows:
+        notify_schedules_changed()
+    return json_response({"created": len(rows), "errors": []})
+
+
+
+@schedules_routes.route("/export.<fmt>")
+def export_schedules(fmt):
+    """
+        Streams every active schedule (`?include_inactive=1` for deleted ones too) as
+        CSV or NDJSON.
+    """
+    header = ["id"] + IMPORT_FIELDS + ["is_active", "is_paused", "created", "last_run"]
+    query = DCASchedule.select(
+        DCASchedule.id,
+        DCASchedule.credential,
+        DCASchedule.market_name,
+        DCASchedule.order_side,
+        DCASchedule.amount,
+        DCASchedule.amount_currency,
+        DCASchedule.repeat_duration,
+        DCASchedule.repeat_timescale,
+        DCASchedule.catch_up_policy,
+        DCASchedule.is_active,
+        DCASchedule.is_paused,
+        DCASchedule.created,
+        DCASchedule.last_run,
+    ).order_by(DCASchedule.id).tuples()
+    if not request.args.get("include_inactive", type=int):
+        query = query.where(DCASchedule.is_active == True)
+
+    if fmt == "csv":
+        return csv_response(header, iterate_query(query), "schedules.csv")
+    elif fmt == "ndjson":
+        return ndjson_response(header, iterate_query(query), "schedules.ndjson")
+    abort(404)
@@ -11,6 +11,7 @@ a = Analysis(['app.py'],
                 ('_templates', '_templates'),
                 ('blueprints/credentials/_templates', 'blueprints/credentials/_templates'),
                 ('blueprints/orders/_templates', 'blueprints/orders/_templates'),
+                ('blueprints/schedules/_templates', 'blueprints/schedules/_templates'),
                 ('_static', '_static')
              ],
              hiddenimports=[],
@@ -1,45 +1,536 @@
 import datetime
+import logging
+import os
+import socket
 import time
 
-from models import APICredential, DCASchedule, Order
-from exchanges.gemini import GeminiExchange, GeminiRequestException
+import analytics
+import archive
+import events
+import metrics
 
+from concurrent.futures import ThreadPoolExecutor
+from models import db, PENDING_ORDER_GRACE, APICredential, DCASchedule, Order
+from exchanges.base import ExchangeNotSupported, OrderSubmissionPending, get_exchange
+from exchanges.market_data import gemini_market_data
+from exchanges.rate_limit import TokenBucket
+from scheduler import schedule_queue
 
 
-def timer_thread():
+
+logger = logging.getLogger(__name__)
+
+# How often to poll live orders for status changes
+ORDER_UPDATE_INTERVAL = 10
+
+# How often to record a price for each market with an active schedule
+PRICE_SNAPSHOT_INTERVAL = 300
+
+# How often to move old terminal orders into the archive; see `archive.archive_orders`
+ARCHIVE_INTERVAL = 60 * 60
+
+# When the daemon runs as its own process the Flask routes can't wake it directly, so
+#   we also watch sqlite's `data_version`, which changes whenever another connection
+#   commits.
+EXTERNAL_CHANGE_INTERVAL = 5
+
+# Max number of due schedules placing orders at the same time. Requests that share an
+#   API key are still serialized by `GeminiApiConnection` to keep nonces increasing.
+DEFAULT_MAX_WORKERS = 8
+
+# Identifies this process in `DCASchedule.lease_owner` when several daemons share the db
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# How long a claimed schedule stays leased before another daemon may assume this one
+#   died mid-order and take it over. Must comfortably exceed the time to place an order.
+DEFAULT_LEASE_SECONDS = 300
+
+# With multiple shards, how late another shard's schedule must be before we run it
+DEFAULT_STEAL_AFTER = 60
+
+# How long to leave a schedule we couldn't claim (its lease has expired but hasn't been
+#   taken over yet) before looking at it again
+CLAIM_RETRY_DELAY = 5
+
+# Coalescing is off by default; see `dispatch_schedules`
+DEFAULT_COALESCE_WINDOW = None
+
+# A schedule more than this many seconds past due is treated as having missed runs
+#   (e.g. the machine was asleep) and handled by its `catch_up_policy`
+CATCH_UP_GRACE = 60
+
+# Overdue runs drain at this many orders/sec (across all schedules) after downtime
+#   instead of all firing at once; on-time runs aren't limited
+DEFAULT_CATCH_UP_RATE = 1.0
+
+# A schedule's missed periods (CATCH_UP__EACH) are spaced so that a full
+#   `DEFAULT_MAX_CATCH_UP` backlog drains over this many seconds
+DEFAULT_CATCH_UP_WINDOW = 60 * 60
+
+# Never replay more than this many missed periods for one schedule; older ones are
+#   skipped
+DEFAULT_MAX_CATCH_UP = 50
+
+
+
+def data_version():
+    return db.execute_sql("PRAGMA data_version").fetchone()[0]
+
+
+
+def run_schedule(schedule):
+    run_schedules([schedule])
+
+
+
+def run_schedules(schedules):
+    """
+        Places the orders for schedules that share a credential, market, side, and
+        amount currency (usually just one).
+    """
+    ids = ", ".join(str(schedule.id) for schedule in schedules)
+    logger.info(f"Running Schedule(s) {ids} {schedules[0].market_name}")
+
+    # Runs on a worker thread; anything raised here would otherwise vanish into the
+    #   discarded Future.
+    try:
+        with db.connection_context():
+            rejected = False
+            try:
+                orders = get_exchange(schedules[0].credential).place_scheduled_orders(schedules)
+                for order in orders:
+                    events.publish_order(order)
+                rejected = any(order.status == Order.STATUS__REJECTED for order in orders)
+            except OrderSubmissionPending as e:
+                Order.release_pending(e.orders)
+                raise
+            finally:
+                for schedule in schedules:
+                    schedule.release_lease(WORKER_ID)
+
+            if rejected:
+                # The adapter rewound these schedules' `last_run`; requeue them now
+                #   rather than at the period we'd already queued
+                schedule_queue.wake()
+    except Exception as e:
+        logger.exception(f"Schedule(s) {ids} failed: {e}")
+
+
+
+def dispatch_schedules(executor, schedules, coalesce):
+    if not coalesce:
+        for schedule in schedules:
+            executor.submit(run_schedules, [schedule])
+        return
+
+    # One aggregated order per (credential, market, side, currency) instead of one
+    #   order book fetch and order per schedule
+    groups = {}
+    for schedule in schedules:
+        key = (schedule.credential_id, schedule.market_name, schedule.order_side, schedule.amount_currency)
+        groups.setdefault(key, []).append(schedule)
+
+    for group in groups.values():
+        executor.submit(run_schedules, group)
+
+
+
+def recover_expired_leases(executor, lease_seconds):
+    """
+        Takes over schedules whose daemon claimed a period but never released the
+        lease. If that daemon got as far as recording the Order the period is done;
+        otherwise we place it now.
+
+        The Order row is journaled before submission, so a daemon that died mid-order
+        left a pending row; that's resolved by `reconcile_pending_orders`, not here.
+    """
+    # Read them all before taking any over; updating while the select's cursor is still
+    #   open can fail with "database is locked"
+    for schedule in list(DCASchedule.expired_leases()):
+        previous_owner = schedule.lease_owner
+        if not schedule.take_over_lease(WORKER_ID, lease_seconds):
+            # Another daemon got there first
+            continue
+
+        if schedule.has_order_for_last_run or schedule.is_paused or not schedule.is_active:
+            schedule.release_lease(WORKER_ID)
+            continue
+
+        logger.warning(f"Schedule {schedule.id} lease from {previous_owner} expired; placing its order")
+        executor.submit(run_schedule, schedule)
+
+
+
+def update_live_orders():
+    # Reconcile in one batch per credential rather than one request per order
+    orders_by_credential = {}
+    live_orders = Order.select(Order, APICredential).join(APICredential).where(
+        Order.order_id.is_null(False) & Order.is_live
+    )
+    for order in live_orders:
+        orders_by_credential.setdefault(order.credential.id, []).append(order)
+    metrics.live_orders.set(sum(len(orders) for orders in orders_by_credential.values()))
+
+    for orders in orders_by_credential.values():
+        credential = orders[0].credential
+        try:
+            exchange = get_exchange(credential)
+        except ExchangeNotSupported as e:
+            logger.warning(e)
+            continue
+
+        # Adapters update the Order instances in place
+        before = {order.id: order.status for order in orders}
+        try:
+            logger.debug(f"Updating {len(orders)} Order(s) for credential {credential.id}")
+            exchange.update_orders(orders)
+        except Exception as e:
+            logger.exception(f"Updating orders for credential {credential.id} failed: {e}")
+
+        for order in orders:
+            if order.status != before[order.id]:
+                events.publish_order(order)
+
+
+
+def reconcile_pending_orders(grace=PENDING_ORDER_GRACE):
+    """
+        Resolves intents whose submission never recorded a result. Only looks at
+        pending rows (indexed), so startup cost doesn't grow with order history.
+    """
+    stale_before = datetime.datetime.now() - datetime.timedelta(seconds=grace)
+    pending = Order.select(Order, APICredential).join(APICredential).where(
+        (Order.status == Order.STATUS__PENDING) & (Order.updated < stale_before)
+    )
+
+    intents = {}
+    for order in pending:
+        intents.setdefault(order.client_order_id, []).append(order)
+
+    for client_order_id, orders in intents.items():
+        if not Order.claim_pending(client_order_id, stale_before):
+            # Another daemon is already on it
+            continue
+
+        credential = orders[0].credential
+        try:
+            get_exchange(credential).reconcile_pending_orders(orders)
+        except Exception as e:
+            logger.exception(f"Reconciling pending order {client_order_id} failed: {e}")
+            continue
+
+        for order in orders:
+            events.publish_order(order)
+
+
+
+def record_price_snapshots():
+    # Read it all up front; inserting while sqlite still has the select's cursor open
+    #   fails with "database is locked" under WAL
+    markets = list(DCASchedule.select(
+        DCASchedule.market_name, APICredential
+    ).join(APICredential).where(
+        DCASchedule.is_active == True
+    ).distinct())
+
+    # One price per (exchange, market), not per schedule or credential
+    seen = set()
+    for schedule in markets:
+        credential = schedule.credential
+        if (credential.exchange, schedule.market_name) in seen:
+            continue
+
+        try:
+            price = get_exchange(credential).get_market_price(schedule.market_name)
+        except ExchangeNotSupported:
+            continue
+        except Exception as e:
+            logger.warning(f"Price snapshot for {schedule.market_name} failed: {e}")
+            continue
+
+        analytics.record_price_snapshot(credential.exchange, schedule.market_name, price)
+        seen.add((credential.exchange, schedule.market_name))
+
+
+
+def run_periodic_task(task, *args):
+    # Anything raised here would otherwise end the timer loop, and with it every schedule
+    try:
+        task(*args)
+    except Exception as e:
+        logger.exception(f"{task.__name__} failed: {e}")
+
+
+
+def claim_retry_time(schedule, now):
+    """
+        When to look again at a due schedule we failed to claim. Requeueing it at its
+        (past) fire time would spin the loop until whoever holds it lets go.
+    """
+    if schedule.lease_expires and schedule.lease_expires > now:
+        return schedule.lease_expires
+    return now + datetime.timedelta(seconds=CLAIM_RETRY_DELAY)
+
+
+
+def catch_up_run(schedule, now, catch_up_window, max_catch_up):
+    """
+        For a CATCH_UP__EACH schedule that's behind, returns `(run_at, next_fire)`: the
+        missed period to record this run as, and when to run the next one. Periods
+        beyond `max_catch_up` are skipped.
+    """
+    missed = schedule.missed_periods(now)
+    skipped = max(missed - max_catch_up, 0)
+    run_at = schedule.last_run + schedule.repeat_interval * (skipped + 1)
+
+    remaining = missed - skipped - 1
+    next_fire = None
+    if remaining > 0:
+        next_fire = now + datetime.timedelta(seconds=catch_up_window / max_catch_up)
+    return (run_at, next_fire)
+
+
+
+def timer_thread(max_workers=DEFAULT_MAX_WORKERS, lease_seconds=DEFAULT_LEASE_SECONDS, coalesce_window=DEFAULT_COALESCE_WINDOW,
+                 catch_up_rate=DEFAULT_CATCH_UP_RATE, catch_up_window=DEFAULT_CATCH_UP_WINDOW, max_catch_up=DEFAULT_MAX_CATCH_UP,
+                 archive_after_days=archive.DEFAULT_ARCHIVE_AFTER_DAYS):
+    """
+        With `coalesce_window` set, schedules due within that many seconds of each
+        other fire together (the later ones slightly early) and are combined into one
+        order per market.
+
+        Terminal orders older than `archive_after_days` are moved to the archive
+        (disabled if None or 0).
+    """
+    if max_catch_up < 1:
+        # Use CATCH_UP__SKIP to not replay missed runs at all
+        raise ValueError("max_catch_up must be at least 1")
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dca_worker")
+    catch_up_limiter = TokenBucket(rate=catch_up_rate, capacity=max(catch_up_rate, 1)) if catch_up_rate else None
+
+    # Keep this thread's connection open for the life of the loop; `data_version` is
+    #   only meaningful when compared on the same connection.
+    db.connect(reuse_if_open=True)
+
+    # Resolve anything a previous run left mid-submission before placing new orders
+    reconcile_pending_orders()
+
+    last_data_version = None
+    next_order_update = time.monotonic()
+    next_price_snapshot = time.monotonic()
+    next_archive = time.monotonic() if archive_after_days else float("inf")
+    next_external_check = time.monotonic()
+
     while True:
-        for schedule in DCASchedule.select().where(DCASchedule.is_paused == False):
-            if schedule.is_time_to_run:
-                print(f"{datetime.datetime.now()}: Running Schedule {schedule.id} {schedule.market_name}")
-                schedule.last_run = datetime.datetime.now()
-                schedule.save()
-
-                if schedule.credential.exchange == APICredential.EXCHANGE__GEMINI:
-                    exchange = GeminiExchange(schedule.credential)                    
-                else:
-                    raise Exception(f"Exchange {schedule.exchange} not implemented yet!")
-
-                try:
-                    order = exchange.place_scheduled_order(schedule)
-                except Exception as e:
-                    print(e)
+        if time.monotonic() >= next_external_check:
+            version = data_version()
+            if version != last_data_version:
+                last_data_version = version
+                schedule_queue.wake()
+            run_periodic_task(recover_expired_leases, executor, lease_seconds)
+            next_external_check = time.monotonic() + EXTERNAL_CHANGE_INTERVAL
 
-        # Update live orders
-        for order in Order.select().where(Order.order_id.is_null(False) & Order.is_live):
-            if order.credential.exchange == APICredential.EXCHANGE__GEMINI:
-                exchange = GeminiExchange(order.credential)                
+        if schedule_queue.needs_reload:
+            with metrics.schedule_scan_seconds.time():
+                schedule_queue.reload()
+
+        now = datetime.datetime.now()
+        horizon = now
+        if coalesce_window:
+            horizon += datetime.timedelta(seconds=coalesce_window)
+
+        claimed = []
+        for schedule_id, fire_time in schedule_queue.pop_due(horizon):
+            schedule = DCASchedule.get_or_none(id=schedule_id)
+            if not schedule or schedule.is_paused or not schedule.is_active:
+                continue
+
+            # The heap can be slightly ahead of the db (e.g. another process already
+            #   ran it); re-check before firing.
+            if not schedule.is_due_by(horizon):
+                schedule_queue.push(schedule)
+                continue
+
+            run_at = None
+            next_fire = None
+            is_late = schedule.last_run and (now - schedule.next_run).total_seconds() > CATCH_UP_GRACE
+            if is_late:
+                if schedule.catch_up_policy == DCASchedule.CATCH_UP__SKIP:
+                    retry_at = None
+                    if schedule.skip_missed_runs(now):
+                        logger.info(f"Schedule {schedule.id} skipped missed runs")
+                    else:
+                        schedule = DCASchedule.get_or_none(id=schedule_id)
+                        if schedule and schedule.is_due_by(horizon):
+                            retry_at = claim_retry_time(schedule, now)
+                    if schedule:
+                        schedule_queue.push(schedule, at=retry_at)
+                    continue
+
+                # Drain the backlog at a controlled rate
+                wait = catch_up_limiter.try_acquire() if catch_up_limiter else 0
+                if wait:
+                    schedule_queue.push(schedule, at=now + datetime.timedelta(seconds=wait))
+                    continue
+
+                if schedule.catch_up_policy == DCASchedule.CATCH_UP__EACH:
+                    run_at, next_fire = catch_up_run(schedule, now, catch_up_window, max_catch_up)
+
+            # Claim the run here, before handing off to the pool, so the requeued
+            #   entry below reflects the new `last_run`. Losing the claim means
+            #   another daemon took this period.
+            if schedule.claim_run(WORKER_ID, lease_seconds, run_at=run_at):
+                metrics.schedule_fire_lag_seconds.observe(max((now - fire_time).total_seconds(), 0))
+                claimed.append(schedule)
+                events.publish_schedule_fired(schedule)
             else:
-                raise Exception(f"Exchange {schedule.exchange} not implemented yet!")
+                next_fire = None
+                schedule = DCASchedule.get_or_none(id=schedule_id)
+                if not schedule:
+                    continue
+                if schedule.is_due_by(horizon):
+                    # Still leased by whoever is placing it (or by a daemon that died)
+                    next_fire = claim_retry_time(schedule, now)
+
+            schedule_queue.push(schedule, at=next_fire)
+
+        if claimed:
+            dispatch_schedules(executor, claimed, coalesce=bool(coalesce_window))
+
+        # Update live orders
+        if time.monotonic() >= next_order_update:
+            run_periodic_task(update_live_orders)
+            run_periodic_task(reconcile_pending_orders)
+            run_periodic_task(analytics.sync_fills)
+            if events.bus.persist:
+                run_periodic_task(events.prune_change_feed)
+            next_order_update = time.monotonic() + ORDER_UPDATE_INTERVAL
+
+        if time.monotonic() >= next_price_snapshot:
+            run_periodic_task(record_price_snapshots)
+            next_price_snapshot = time.monotonic() + PRICE_SNAPSHOT_INTERVAL
 
+        if time.monotonic() >= next_archive:
             try:
-                print(f"{datetime.datetime.now()}: Updating Order {order.id}")
-                exchange.update_order(order)
+                archived = archive.archive_orders(archive_after_days)
             except Exception as e:
-                print(e)
+                logger.exception(f"Order archival failed: {e}")
+                archived = 0
+            # Come back sooner while there's still a backlog to work through
+            interval = ORDER_UPDATE_INTERVAL if archived >= archive.ARCHIVE_BATCH_SIZE * archive.DEFAULT_MAX_BATCHES else ARCHIVE_INTERVAL
+            next_archive = time.monotonic() + interval
 
-        time.sleep(10)
+        timeout = min(next_order_update, next_external_check, next_price_snapshot, next_archive) - time.monotonic()
+        schedule_queue.wait(max(timeout, 0))
 
 
 
 if __name__ == "__main__":
-	timer_thread()
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="""
+            Bonsai DCA - background daemon
+        """,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    # options
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=DEFAULT_MAX_WORKERS,
+                        dest="max_workers",
+                        help="Max number of orders to place concurrently")
+    parser.add_argument('-s', '--stream-market-data',
+                        action="store_true",
+                        default=False,
+                        dest="stream_market_data",
+                        help="Price orders from a live websocket top-of-book feed")
+    parser.add_argument('--gemini-api-url',
+                        default=None,
+                        dest="gemini_api_url",
+                        help="Gemini REST API base url (e.g. https://api.sandbox.gemini.com/v1)")
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        default=None,
+                        dest="metrics_port",
+                        help="Serve Prometheus metrics on this port")
+    parser.add_argument('--shard-index',
+                        type=int,
+                        default=0,
+                        dest="shard_index",
+                        help="Which shard of the schedules this daemon owns (0-based)")
+    parser.add_argument('--shard-count',
+                        type=int,
+                        default=1,
+                        dest="shard_count",
+                        help="Total number of daemons splitting the schedules")
+    parser.add_argument('--steal-after',
+                        type=float,
+                        default=DEFAULT_STEAL_AFTER,
+                        dest="steal_after",
+                        help="Run other shards' schedules once they're this many seconds overdue (0 to disable)")
+    parser.add_argument('--lease-seconds',
+                        type=float,
+                        default=DEFAULT_LEASE_SECONDS,
+                        dest="lease_seconds",
+                        help="How long a claimed schedule stays leased before another daemon may take it over")
+    parser.add_argument('--coalesce-window',
+                        type=float,
+                        default=DEFAULT_COALESCE_WINDOW,
+                        dest="coalesce_window",
+                        help="Combine same-market schedules due within this many seconds into one order")
+    parser.add_argument('--catch-up-rate',
+                        type=float,
+                        default=DEFAULT_CATCH_UP_RATE,
+                        dest="catch_up_rate",
+                        help="Max overdue runs per second after downtime (0 for no limit)")
+    parser.add_argument('--catch-up-window',
+                        type=float,
+                        default=DEFAULT_CATCH_UP_WINDOW,
+                        dest="catch_up_window",
+                        help="Seconds to spread a full backlog of missed runs over (catch-up policy 'each')")
+    parser.add_argument('--max-catch-up',
+                        type=int,
+                        default=DEFAULT_MAX_CATCH_UP,
+                        dest="max_catch_up",
+                        help="Max missed runs to replay per schedule (catch-up policy 'each'); at least 1")
+    parser.add_argument('--archive-after',
+                        type=float,
+                        default=archive.DEFAULT_ARCHIVE_AFTER_DAYS,
+                        dest="archive_after_days",
+                        help="Archive completed/cancelled/rejected orders older than this many days (0 to disable)")
+    parser.add_argument('--log-level',
+                        default="INFO",
+                        dest="log_level",
+                        help="DEBUG, INFO, WARNING, or ERROR")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+
+    if args.gemini_api_url:
+        from exchanges.gemini import GeminiApiConnection
+        GeminiApiConnection.set_base_url(args.gemini_api_url)
+
+    if args.stream_market_data:
+        gemini_market_data.enable()
+
+    # The server can't see this process's events directly; send them via the db
+    events.bus.persist = True
+
+    schedule_queue.configure_shard(args.shard_index, args.shard_count, steal_after=args.steal_after)
+
+    timer_thread(
+        max_workers=args.max_workers,
+        lease_seconds=args.lease_seconds,
+        coalesce_window=args.coalesce_window,
+        catch_up_rate=args.catch_up_rate,
+        catch_up_window=args.catch_up_window,
+        max_catch_up=args.max_catch_up,
+        archive_after_days=args.archive_after_days
+    )
@@ -0,0 +1,185 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+
+from models import db, ChangeEvent
+from serializers import dumps
+
+
+
+logger = logging.getLogger(__name__)
+
+# Event types
+ORDER = "order"                     # an Order was placed or changed status
+SCHEDULE_FIRED = "schedule_fired"
+
+# Sent to idle streams so proxies and browsers don't drop the connection
+KEEPALIVE_INTERVAL = 15
+
+# How often the relay checks whether a separate daemon process wrote new events
+RELAY_POLL_INTERVAL = 0.25
+
+# Change feed rows only need to live long enough for the server's relay to see them
+CHANGE_FEED_RETENTION = 10 * 60
+
+
+
+class Event(object):
+    def __init__(self, event_type: str, payload: str):
+        self.event_type = event_type
+        self.payload = payload
+
+
+    def to_sse(self):
+        return f"event: {self.event_type}\ndata: {self.payload}\n\n"
+
+
+
+class Subscriber(object):
+    # Events for a client that stops reading are dropped rather than buffered forever
+    MAX_QUEUED = 1000
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=Subscriber.MAX_QUEUED)
+
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            pass
+
+
+    def get(self, timeout=None):
+        """
+            Returns the next Event, or None after `timeout` seconds with nothing new.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+
+class EventBus(object):
+    """
+        In-process pub/sub for pushing order and schedule updates to the UI (see the
+        `/events` route).
+
+        When the daemon runs as a thread of the server, publishing delivers straight to
+        subscribers. A separate daemon process sets `persist = True` so events are also
+        written to the `ChangeEvent` table, and the server's relay thread republishes
+        them to its own subscribers.
+    """
+    def __init__(self):
+        self.persist = False
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._has_subscribers = threading.Event()
+        self._relay = None
+
+
+    def publish(self, event_type: str, data):
+        event = Event(event_type, dumps(data))
+        if self.persist:
+            ChangeEvent.create(event_type=event.event_type, payload=event.payload)
+        self._deliver(event)
+
+
+    def _deliver(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        with self._lock:
+            self._subscribers.add(subscriber)
+            self._has_subscribers.set()
+        return subscriber
+
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            if not self._subscribers:
+                self._has_subscribers.clear()
+
+
+    def start_relay(self):
+        """
+            Relays events written to the change feed by another process. Only touches
+            the db while someone is subscribed, and then only runs a query once sqlite's
+            `data_version` shows another connection has committed.
+        """
+        if self._relay:
+            return
+        self._relay = threading.Thread(target=self._run_relay, daemon=True, name="event_relay")
+        self._relay.start()
+
+
+    def _run_relay(self):
+        last_id = None
+        last_data_version = None
+        while True:
+            if not self._has_subscribers.is_set():
+                # Pick up from the newest event once someone subscribes again
+                last_id = None
+                self._has_subscribers.wait()
+
+            try:
+                with db.connection_context():
+                    if last_id is None:
+                        last_id = ChangeEvent.select(ChangeEvent.id).order_by(ChangeEvent.id.desc()).limit(1).scalar() or 0
+
+                    # `data_version` only means something compared on one connection,
+                    #   so poll for a while before releasing it.
+                    stop_at = time.monotonic() + KEEPALIVE_INTERVAL
+                    while self._has_subscribers.is_set() and time.monotonic() < stop_at:
+                        data_version = db.execute_sql("PRAGMA data_version").fetchone()[0]
+                        if data_version != last_data_version:
+                            last_data_version = data_version
+                            for event_id, event_type, payload in ChangeEvent.select(
+                                ChangeEvent.id, ChangeEvent.event_type, ChangeEvent.payload
+                            ).where(
+                                ChangeEvent.id > last_id
+                            ).order_by(ChangeEvent.id).tuples():
+                                self._deliver(Event(event_type, payload))
+                                last_id = event_id
+                        time.sleep(RELAY_POLL_INTERVAL)
+                    last_data_version = None
+            except Exception as e:
+                logger.exception(f"Event relay failed: {e}")
+                time.sleep(RELAY_POLL_INTERVAL)
+
+
+
+bus = EventBus()
+
+
+
+def publish_order(order):
+    data = order.to_json()
+    data["exchange"] = order.credential.exchange
+    bus.publish(ORDER, data)
+
+
+
+def publish_schedule_fired(schedule):
+    bus.publish(SCHEDULE_FIRED, {
+        "id": schedule.id,
+        "credential": schedule.credential_id,
+        "market_name": schedule.market_name,
+        "last_run": schedule.last_run,
+        "next_run": schedule.next_run,
+    })
+
+
+
+def prune_change_feed():
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=CHANGE_FEED_RETENTION)
+    ChangeEvent.delete().where(ChangeEvent.created < cutoff).execute()
@@ -0,0 +1,146 @@
+import threading
+
+from abc import ABC, abstractmethod
+
+
+
+class ExchangeNotSupported(Exception):
+    pass
+
+
+
+class OrderSubmissionPending(Exception):
+    """
+        Raised when an order's intent was journaled but we can't tell whether the
+        exchange accepted it (network errors, 5xx). `orders` are the pending rows;
+        they're left for `reconcile_pending_orders` to resolve and must not be
+        resubmitted by the caller.
+    """
+    def __init__(self, orders, cause):
+        super().__init__(f"Order {orders[0].client_order_id} submission is pending: {cause}")
+        self.orders = orders
+
+
+
+class ExchangeAdapter(ABC):
+    """
+        Interface every exchange integration implements. Subclasses set `exchange` to
+        the matching `APICredential.EXCHANGE__*` value and register themselves with
+        `@register_exchange`.
+
+        Instances are cached per credential (see `get_exchange`) and shared across the
+        daemon's worker threads, so they must not keep per-order state on `self`.
+
+        The abstract methods must all be implemented; a missing one fails when the
+        adapter is instantiated rather than partway through placing an order.
+    """
+    exchange = None
+
+    def __init__(self, api_credential):
+        self.api_credential = api_credential
+
+
+    @abstractmethod
+    def place_order(self, market_name, order_side, amount, amount_currency, schedule=None):
+        """
+            Submits the order and returns the resulting `Order` row.
+        """
+
+
+    def place_scheduled_order(self, schedule):
+        return self.place_order(
+            schedule.market_name,
+            schedule.order_side,
+            schedule.amount,
+            schedule.amount_currency,
+            schedule=schedule
+        )
+
+
+    def place_scheduled_orders(self, schedules):
+        """
+            Places orders for due schedules that share a market, side, and amount
+            currency. Adapters that can combine them into a single exchange order
+            should override this; returns one `Order` per schedule.
+        """
+        return [self.place_scheduled_order(schedule) for schedule in schedules]
+
+
+    @abstractmethod
+    def reconcile_pending_orders(self, orders):
+        """
+            Resolves `Order.STATUS__PENDING` rows (intents journaled before submission
+            whose outcome was never recorded) by looking them up on the exchange by
+            `client_order_id`.
+        """
+
+
+    @abstractmethod
+    def get_market_price(self, market_name):
+        """
+            Current mid-market price, for valuing positions.
+        """
+
+
+    @abstractmethod
+    def update_order(self, order):
+        pass
+
+
+    def update_orders(self, orders):
+        # Adapters whose exchange supports batch lookups should override this
+        for order in orders:
+            self.update_order(order)
+
+
+
+_adapters = {}
+_builtins_loaded = False
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+
+def register_exchange(adapter_class):
+    _adapters[adapter_class.exchange] = adapter_class
+    return adapter_class
+
+
+
+def _load_builtin_adapters():
+    # Imported here rather than at module load to avoid a circular import; each
+    #   module registers its adapter as a side effect.
+    global _builtins_loaded
+    import exchanges.gemini
+    import exchanges.fake
+    _builtins_loaded = True
+
+
+
+def get_exchange(api_credential):
+    """
+        Returns the cached adapter for this credential, building it on first use (or if
+        the credential's keys have changed since).
+    """
+    if not _builtins_loaded:
+        _load_builtin_adapters()
+
+    adapter_class = _adapters.get(api_credential.exchange)
+    if not adapter_class:
+        raise ExchangeNotSupported(f"Exchange {api_credential.exchange} not implemented yet!")
+
+    cache_key = (api_credential.exchange, api_credential.client_key, api_credential.client_secret)
+    with _instances_lock:
+        cached = _instances.get(api_credential.id)
+        if cached and cached[0] == cache_key:
+            return cached[1]
+
+        adapter = adapter_class(api_credential)
+        _instances[api_credential.id] = (cache_key, adapter)
+        return adapter
+
+
+
+def forget_exchange(credential_id):
+    with _instances_lock:
+        _instances.pop(credential_id, None)
@@ -0,0 +1,145 @@
+import datetime
+import itertools
+import random
+import threading
+import time
+
+from decimal import Decimal
+
+import metrics
+
+from exchanges.base import ExchangeAdapter, register_exchange
+from models import APICredential, Order
+
+
+
+@register_exchange
+class FakeExchange(ExchangeAdapter):
+    """
+        In-process simulated exchange for load testing and benchmarking the whole
+        schedule -> order pipeline offline. Create an `APICredential` with
+        `exchange=APICredential.EXCHANGE__FAKE` to use it.
+
+        Orders rest for `fill_after` seconds and then fill completely at the price they
+        were placed at. Every simulated API call sleeps for `latency` seconds.
+    """
+    exchange = APICredential.EXCHANGE__FAKE
+
+    latency = 0.0
+    fill_after = 0.0
+    insufficient_funds_rate = 0.0
+    bid = Decimal("49999.99")
+    ask = Decimal("50000.01")
+    quote_increment = Decimal("0.01")
+    base_increment = Decimal("0.00000001")
+
+    _order_ids = itertools.count(1)
+    _order_ids_lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, latency: float = None, fill_after: float = None, insufficient_funds_rate: float = None):
+        if latency is not None:
+            cls.latency = latency
+        if fill_after is not None:
+            cls.fill_after = fill_after
+        if insufficient_funds_rate is not None:
+            cls.insufficient_funds_rate = insufficient_funds_rate
+
+
+    def _simulate_api_call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+    def _next_order_id(self):
+        with FakeExchange._order_ids_lock:
+            return f"fake-{next(FakeExchange._order_ids)}"
+
+
+    def get_market_price(self, market_name):
+        return (self.bid + self.ask) / Decimal("2")
+
+
+    def place_order(self, market_name, order_side, amount, amount_currency, schedule=None):
+        # Journaled first, like a real adapter; see `GeminiExchange.place_order`
+        order = Order.create(
+            schedule=schedule,
+            run_at=schedule.last_run if schedule else None,
+            credential=self.api_credential,
+            client_order_id=Order.new_client_order_id(),
+            market_name=market_name,
+            order_side=order_side,
+            amount=amount,
+            amount_currency=amount_currency,
+            raw_data={},
+            status=Order.STATUS__PENDING,
+            updated=datetime.datetime.now()
+        )
+        self._submit(order)
+        return order
+
+
+    def _submit(self, order):
+        self._simulate_api_call()
+        price = ((self.bid + self.ask) / Decimal("2")).quantize(self.quote_increment)
+        quantity = (order.amount / price).quantize(self.base_increment)
+        order.updated = datetime.datetime.now()
+
+        if random.random() < self.insufficient_funds_rate:
+            order.raw_data = {"result": "error", "reason": "InsufficientFunds"}
+            order.status = Order.STATUS__INSUFFICIENT_FUNDS
+            order.is_live = False
+        else:
+            order.order_id = self._next_order_id()
+            order.raw_data = {
+                "order_id": order.order_id,
+                "client_order_id": order.client_order_id,
+                "symbol": order.market_name.lower(),
+                "side": order.order_side,
+                "price": str(price),
+                "original_amount": str(quantity),
+                "executed_amount": "0",
+                "avg_execution_price": "0.00",
+                "is_live": True,
+                "is_cancelled": False,
+            }
+            order.status = Order.STATUS__OPEN
+            order.executed_amount = Decimal("0")
+
+        order.save()
+        metrics.orders_placed_total.inc(exchange=self.exchange, status=order.status)
+
+
+    def reconcile_pending_orders(self, orders):
+        # Nothing survives a restart of the simulated exchange, so any pending intent
+        #   is one it never received
+        for order in orders:
+            self._submit(order)
+
+
+    def update_order(self, order):
+        self.update_orders([order])
+
+
+    def update_orders(self, orders):
+        # One simulated call for the whole batch, like a real /orders lookup
+        self._simulate_api_call()
+
+        fill_before = datetime.datetime.now() - datetime.timedelta(seconds=self.fill_after)
+        for order in orders:
+            if order.created > fill_before:
+                continue
+
+            raw_data = dict(order.raw_data)
+            raw_data.update({
+                "executed_amount": raw_data["original_amount"],
+                "avg_execution_price": raw_data["price"],
+                "is_live": False,
+            })
+            order.raw_data = raw_data
+            order.executed_amount = Decimal(raw_data["executed_amount"])
+            order.avg_execution_price = Decimal(raw_data["avg_execution_price"])
+            order.status = Order.STATUS__COMPLETE
+            order.is_live = False
+            order.updated = datetime.datetime.now()
+            order.save()
@@ -4,13 +4,27 @@ import decimal
 import json
 import hashlib
 import hmac
+import logging
 import math
-import requests
+import threading
 import time
 
+import requests
+
 from decimal import Decimal
 
-from models import Order
+import metrics
+
+from exchanges import session
+from exchanges.base import ExchangeAdapter, OrderSubmissionPending, register_exchange
+from exchanges.market_data import gemini_market_data
+from exchanges.rate_limit import RateLimiter
+from exchanges.symbol_cache import SymbolDetailsCache
+from models import db, Order
+
+
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -22,50 +36,131 @@ class GeminiRequestException(Exception):
 
 
 
-class GeminiApiConnection(object):
+class SubmissionOutcomeUnknown(Exception):
+    """
+        The /order/new request may or may not have placed the order (network error,
+        timeout, or 5xx).
+    """
+    pass
+
 
-    def __init__(self, client_key: str, client_secret: str):
+
+class GeminiApiConnection(object):
+    # Gemini rejects any nonce that isn't greater than the last one it saw for an API
+    #   key, so authenticated requests are serialized per key (across all instances and
+    #   threads) while different keys can proceed in parallel.
+    _key_locks = {}
+    _key_locks_lock = threading.Lock()
+    _last_nonces = {}
+
+    PRODUCTION_BASE_URL = "https://api.gemini.com/v1"
+    SANDBOX_BASE_URL = "https://api.sandbox.gemini.com/v1"
+    base_url = PRODUCTION_BASE_URL
+
+    # Gemini's documented limits: 120 req/min for public endpoints (per IP) and 600
+    #   req/min for private endpoints (per API key). Requests over the limit are queued
+    #   here rather than sent and bounced with a 429. Set to None to disable.
+    public_rate_limiter = RateLimiter(rate=120 / 60, capacity=2)
+    private_rate_limiter = RateLimiter(rate=600 / 60, capacity=5)
+
+    def __init__(self, client_key: str, client_secret: str, base_url: str = None):
         self.client_key = client_key
         self.client_secret = client_secret.encode()
+        if base_url:
+            self.base_url = base_url
 
 
-    def _make_public_request(self, endpoint: str):
-        base_url = "https://api.gemini.com/v1"
-        url = base_url + endpoint
+    @classmethod
+    def set_base_url(cls, base_url: str):
+        """
+            Points every connection at a different API host, e.g. `SANDBOX_BASE_URL` or
+            a local stand-in.
+        """
+        cls.base_url = base_url.rstrip("/")
 
-        r = requests.get(url)
 
-        if r.status_code == 200:
-            return r.json()
-        else:
-            raise GeminiRequestException(r.status_code, r.json())
+    @classmethod
+    def _get_key_lock(cls, client_key: str):
+        with cls._key_locks_lock:
+            if client_key not in cls._key_locks:
+                cls._key_locks[client_key] = threading.Lock()
+            return cls._key_locks[client_key]
 
 
-    def _make_authenticated_request(self, verb: str, endpoint: str, payload: dict = {}):
-        base_url = "https://api.gemini.com/v1"
-        url = base_url + endpoint
-
+    def _next_nonce(self):
+        # Must be called while holding this key's lock
         t = datetime.datetime.now()
 
         # Include microsecond precision to avoid InvalidNonce errors for duplicate nonces
         #   on consecutive calls.
-        payload["nonce"] = str(int(time.mktime(t.timetuple()) * 1000 + t.microsecond / 1000))
-        payload["request"] = "/v1" + endpoint
+        nonce = int(time.mktime(t.timetuple()) * 1000 + t.microsecond / 1000)
+
+        # Guarantee strictly increasing nonces even if the clock hasn't advanced
+        nonce = max(nonce, GeminiApiConnection._last_nonces.get(self.client_key, 0) + 1)
+        GeminiApiConnection._last_nonces[self.client_key] = nonce
+        return str(nonce)
+
 
-        encoded_payload = json.dumps(payload).encode()
-        b64 = base64.b64encode(encoded_payload)
-        signature = hmac.new(self.client_secret, b64, hashlib.sha384).hexdigest()
+    def _make_public_request(self, endpoint: str, metric_endpoint: str = None):
+        url = self.base_url + endpoint
+        metric_endpoint = metric_endpoint or endpoint
 
-        request_headers = { 'Content-Type': "text/plain",
-                            'Content-Length': "0",
-                            'X-GEMINI-APIKEY': self.client_key,
-                            'X-GEMINI-PAYLOAD': b64,
-                            'X-GEMINI-SIGNATURE': signature,
-                            'Cache-Control': "no-cache" }
+        if self.public_rate_limiter:
+            self.public_rate_limiter.acquire("public")
 
-        r = requests.post(url,
-                          data=None,
-                          headers=request_headers)
+        # 429/5xx retries with backoff are handled by the shared session's adapter
+        with metrics.exchange_api_seconds.time(exchange="gemini", endpoint=metric_endpoint):
+            r = session.get_session().get(url, timeout=session.get_timeout())
+        metrics.exchange_api_requests_total.inc(exchange="gemini", endpoint=metric_endpoint, status=r.status_code)
+
+        if r.status_code == 200:
+            return r.json()
+        else:
+            raise GeminiRequestException(r.status_code, r.json())
+
+
+    def _make_authenticated_request(self, verb: str, endpoint: str, payload: dict = {}):
+        url = self.base_url + endpoint
+        retries, backoff_factor = session.get_retry_config()
+
+        # Hold the lock until the request has been sent so the exchange receives this
+        #   key's nonces in order.
+        with self._get_key_lock(self.client_key):
+            for attempt in range(retries + 1):
+                if self.private_rate_limiter:
+                    self.private_rate_limiter.acquire(self.client_key)
+
+                payload["nonce"] = self._next_nonce()
+                payload["request"] = "/v1" + endpoint
+
+                encoded_payload = json.dumps(payload).encode()
+                b64 = base64.b64encode(encoded_payload)
+                signature = hmac.new(self.client_secret, b64, hashlib.sha384).hexdigest()
+
+                request_headers = { 'Content-Type': "text/plain",
+                                    'Content-Length': "0",
+                                    'X-GEMINI-APIKEY': self.client_key,
+                                    'X-GEMINI-PAYLOAD': b64,
+                                    'X-GEMINI-SIGNATURE': signature,
+                                    'Cache-Control': "no-cache" }
+
+                with metrics.exchange_api_seconds.time(exchange="gemini", endpoint=endpoint):
+                    r = session.get_session().post(url,
+                                                   data=None,
+                                                   headers=request_headers,
+                                                   timeout=session.get_timeout())
+                metrics.exchange_api_requests_total.inc(exchange="gemini", endpoint=endpoint, status=r.status_code)
+
+                # Only a 429 is safe to resend: the request was refused outright. A 5xx
+                #   on e.g. /order/new may still have placed the order.
+                if r.status_code != 429 or attempt == retries:
+                    break
+
+                retry_after = r.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    time.sleep(int(retry_after))
+                else:
+                    time.sleep(backoff_factor * (2 ** attempt))
 
         if r.status_code == 200:
             return r.json()
@@ -86,10 +181,10 @@ class GeminiApiConnection(object):
                 'status': 'open'
             }
         """
-        return self._make_public_request(f"/symbols/details/{market}")
+        return self._make_public_request(f"/symbols/details/{market}", metric_endpoint="/symbols/details")
 
 
-    def current_order_book(self, market: str):
+    def current_order_book(self, market: str, depth: int = None):
         """
             {
                 "bids": [
@@ -110,12 +205,14 @@ class GeminiApiConnection(object):
                 ]
             }
         """
-        return self._make_public_request(f"/book/{market}")
+        if depth:
+            return self._make_public_request(f"/book/{market}?limit_bids={depth}&limit_asks={depth}", metric_endpoint="/book")
+        return self._make_public_request(f"/book/{market}", metric_endpoint="/book")
 
 
 
     """ **************************** Authenticated Requests **************************** """
-    def new_order(self, market: str, side: str, amount: Decimal, price: Decimal):
+    def new_order(self, market: str, side: str, amount: Decimal, price: Decimal, client_order_id: str = None):
         if side not in ["buy", "sell"]:
             raise Exception(f"Invalid 'side': {side}")
 
@@ -127,32 +224,82 @@ class GeminiApiConnection(object):
             "type": "exchange limit",
             "options": ["maker-or-cancel"]  
         }
+        if client_order_id:
+            payload["client_order_id"] = client_order_id
         return self._make_authenticated_request("POST", "/order/new", payload=payload)
 
 
-    def order_status(self, order_id: str):
+    def order_status(self, order_id: str = None, client_order_id: str = None):
+        """
+            Looking up by `client_order_id` returns a list of every order placed with
+            that id.
+        """
         payload = {
-            "order_id": order_id,
-            "include_trades": False,
+            "include_trades": True,     # Needed for the fee
         }
+        if order_id:
+            payload["order_id"] = order_id
+        else:
+            payload["client_order_id"] = client_order_id
         return self._make_authenticated_request("POST", "/order/status", payload=payload)
 
 
+    def active_orders(self):
+        """
+            Returns the order status of every live order for this API key:
+            [
+                {
+                    "order_id": "107421210",
+                    "symbol": "btcusd",
+                    "is_live": true,
+                    "is_cancelled": false,
+                    "executed_amount": "0",
+                    "remaining_amount": "0.00071",
+                    "original_amount": "0.00071",
+                    "avg_execution_price": "0.00",
+                    ...
+                },
+                ...,
+            ]
+        """
+        return self._make_authenticated_request("POST", "/orders", payload={})
 
-class GeminiExchange(object):
-    from models import APICredential
-    exchange = APICredential.EXCHANGE__GEMINI
 
-    def __init__(self, api_credential):
-        self.api_credential = api_credential
-        self.api_conn = GeminiApiConnection(client_key=api_credential.client_key, client_secret=api_credential.client_secret)
+    def my_trades(self, market: str, since: datetime.datetime = None, limit: int = 500):
+        """
+            [
+                {
+                    "price": "3648.09",
+                    "amount": "0.0027343246",
+                    "timestamp": 1547232911,
+                    "fee_currency": "USD",
+                    "fee_amount": "0.024937655575035",
+                    "order_id": "107317526",
+                    ...
+                },
+                ...,
+            ]
+        """
+        payload = {
+            "symbol": market,
+            "limit_trades": limit,
+        }
+        if since:
+            payload["timestamp"] = int(since.timestamp())
+        return self._make_authenticated_request("POST", "/mytrades", payload=payload)
 
 
-    def initialize_market(self, market_name, amount_currency, order_side):
+
+class GeminiMarket(object):
+    """
+        Everything needed to price and size a single order on one market. Kept separate
+        from `GeminiExchange` so one cached adapter can place orders for several
+        schedules at the same time.
+    """
+    def __init__(self, market_name, amount_currency, order_side, symbol_details):
         self.market_name = market_name
         self.amount_currency = amount_currency
         self.order_side = order_side
-        symbol_details = self.api_conn.symbol_details(market_name)
 
         self.base_currency = symbol_details.get("base_currency")
         self.quote_currency = symbol_details.get("quote_currency")
@@ -168,76 +315,125 @@ class GeminiExchange(object):
             raise Exception(f"amount_currency {amount_currency} not in market {self.market_name}")
 
 
-    def calculate_order_price(self):
-        order_book = self.api_conn.current_order_book(self.market_name)
-
-        bid = Decimal(order_book.get('bids')[0].get('price')).quantize(self.quote_increment)
-        ask = Decimal(order_book.get('asks')[0].get('price')).quantize(self.quote_increment)
+    def midmarket_price(self, bid, ask):
+        bid = bid.quantize(self.quote_increment)
+        ask = ask.quantize(self.quote_increment)
 
         # Avg the bid/ask but round to nearest quote_increment
         if self.order_side == "buy":
-            midmarket_price = (math.floor((ask + bid) / Decimal('2.0') / self.quote_increment) * self.quote_increment).quantize(self.quote_increment, decimal.ROUND_DOWN)
+            return (math.floor((ask + bid) / Decimal('2.0') / self.quote_increment) * self.quote_increment).quantize(self.quote_increment, decimal.ROUND_DOWN)
         else:
-            midmarket_price = (math.floor((ask + bid) / Decimal('2.0') / self.quote_increment) * self.quote_increment).quantize(self.quote_increment, decimal.ROUND_UP)
-        print(f"ask: ${ask}")
-        print(f"bid: ${bid}")
-        print(f"midmarket_price: ${midmarket_price}")
+            return (math.floor((ask + bid) / Decimal('2.0') / self.quote_increment) * self.quote_increment).quantize(self.quote_increment, decimal.ROUND_UP)
 
-        return midmarket_price
 
-
-    def place_limit_order(self, amount, price):
+    def order_quantity(self, amount, price):
+        # Base currency quantity for `amount` (in `amount_currency`) at `price`
         if self.amount_currency_is_quote_currency:
-            result = self.api_conn.new_order(
-                market=self.market_name,
-                side=self.order_side,
-                amount=float((amount / price).quantize(self.base_increment)),
-                price=price
-            )
+            return (amount / price).quantize(self.base_increment)
         else:
-            result = self.api_conn.new_order(
-                market=self.market_name,
-                side=self.order_side,
-                amount=float(amount.quantize(self.base_increment)),
-                price=price
-            )
-        return result
+            return amount.quantize(self.base_increment)
 
 
-    def place_order(self, market_name, order_side, amount, amount_currency, schedule=None):
-        self.initialize_market(market_name, amount_currency, order_side)
-        price = self.calculate_order_price()
+
+@register_exchange
+class GeminiExchange(ExchangeAdapter):
+    from models import APICredential
+    exchange = APICredential.EXCHANGE__GEMINI
+
+    # Shared by every GeminiExchange instance in the process
+    symbol_details_cache = SymbolDetailsCache(exchange)
+
+    # Order rejections that may mean our cached symbol details are out of date
+    STALE_SYMBOL_DETAILS_REASONS = ["InvalidQuantity", "InvalidPrice"]
+
+    def __init__(self, api_credential):
+        super().__init__(api_credential)
+        self.api_conn = GeminiApiConnection(client_key=api_credential.client_key, client_secret=api_credential.client_secret)
+
+
+    def initialize_market(self, market_name, amount_currency, order_side):
+        symbol_details = GeminiExchange.symbol_details_cache.get(market_name, self.api_conn.symbol_details)
+        return GeminiMarket(market_name, amount_currency, order_side, symbol_details)
+
+
+    def get_top_of_book(self, market_name):
+        # Prefer the in-memory streaming feed; otherwise only fetch the top level
+        top_of_book = gemini_market_data.get_top_of_book(market_name)
+        if top_of_book:
+            return top_of_book
+
+        order_book = self.api_conn.current_order_book(market_name, depth=1)
+        return (Decimal(order_book.get('bids')[0].get('price')), Decimal(order_book.get('asks')[0].get('price')))
+
+
+    def get_market_price(self, market_name):
+        bid, ask = self.get_top_of_book(market_name)
+        return (bid + ask) / Decimal("2")
+
+
+    def calculate_order_price(self, market):
+        bid, ask = self.get_top_of_book(market.market_name)
+        midmarket_price = market.midmarket_price(bid, ask)
+        logger.debug(f"{market.market_name} ask: ${ask} bid: ${bid} midmarket_price: ${midmarket_price}")
+
+        return midmarket_price
+
+
+    def place_limit_order(self, market, amount, price, client_order_id=None):
+        return self.api_conn.new_order(
+            market=market.market_name,
+            side=market.order_side,
+            amount=float(market.order_quantity(amount, price)),
+            price=price,
+            client_order_id=client_order_id
+        )
+
+
+    def submit_order(self, market_name, order_side, amount, amount_currency, client_order_id=None):
+        """
+            Prices and places the limit order. Returns `(result, status, is_live)` without
+            writing anything to the db.
+
+            Raises `SubmissionOutcomeUnknown` if we can't tell whether the exchange
+            accepted the order (network errors, timeouts, 5xx). Anything raised before
+            the order is sent (unknown market, empty book, ...) propagates as is.
+        """
+        with metrics.order_stage_seconds.time(stage="symbol_lookup"):
+            market = self.initialize_market(market_name, amount_currency, order_side)
+
+        with metrics.order_stage_seconds.time(stage="order_book"):
+            price = self.calculate_order_price(market)
 
         try:
-            result = self.place_limit_order(amount, price)
-            print(json.dumps(result, indent=4))
+            with metrics.order_stage_seconds.time(stage="order_submit"):
+                result = self.place_limit_order(market, amount, price, client_order_id=client_order_id)
+            logger.debug(json.dumps(result, indent=4))
+        except requests.RequestException as e:
+            raise SubmissionOutcomeUnknown(e) from e
         except GeminiRequestException as e:
-            print(f"Order returned error: {e.status_code}")
-            print(json.dumps(e.response_json, indent=2))
+            if e.status_code >= 500:
+                raise SubmissionOutcomeUnknown(e) from e
+            logger.warning(f"Order returned error: {e.status_code} {json.dumps(e.response_json)}")
             result = e.response_json
 
+        if result.get("result") == "error" and result.get("reason") in GeminiExchange.STALE_SYMBOL_DETAILS_REASONS:
+            GeminiExchange.symbol_details_cache.invalidate(market_name)
 
-        order = Order.create(
-            schedule=schedule,
-            credential=self.api_credential,
-            exchange=GeminiExchange.exchange,
-            order_id=result.get("order_id"),
-            market_name=market_name,
-            order_side=order_side,
-            amount=amount,
-            amount_currency=amount_currency,
-            raw_data=result
-        )
+        return (result, *GeminiExchange.new_order_status(result))
+
+
+    @staticmethod
+    def new_order_status(result):
+        """
+            Returns `(status, is_live)` for a /order/new response.
+        """
+        status = Order.STATUS__OPEN
+        is_live = True
 
         # Sometimes orders are rejected because the order book moved
         if result.get("is_cancelled") and result.get("reason") == "MakerOrCancelWouldTake":
-            order.status = Order.STATUS__REJECTED
-            order.is_live = False
-            order.save()
-
-            # Reset the schedule so it runs again
-            if schedule:
-                schedule.undo_last_run()
+            status = Order.STATUS__REJECTED
+            is_live = False
 
         # Order rejected due to insufficient funds
         """
@@ -248,9 +444,8 @@ class GeminiExchange(object):
             }
         """
         if result.get("result") == "error" and result.get("reason") == "InsufficientFunds":
-            order.status = Order.STATUS__INSUFFICIENT_FUNDS
-            order.is_live = False
-            order.save()
+            status = Order.STATUS__INSUFFICIENT_FUNDS
+            is_live = False
 
         # Order rejected due to min order size
         """
@@ -261,26 +456,190 @@ class GeminiExchange(object):
             }
         """
         if result.get("result") == "error" and result.get("reason") == "InvalidQuantity":
-            order.status = Order.STATUS__MIN_ORDER_SIZE
-            order.is_live = False
-            order.save()
+            status = Order.STATUS__MIN_ORDER_SIZE
+            is_live = False
 
-        return order
+        return (status, is_live)
 
 
-    def place_scheduled_order(self, schedule):
-        return self.place_order(
-            schedule.market_name,
-            schedule.order_side,
-            schedule.amount,
-            schedule.amount_currency,
-            schedule=schedule
+    def place_order(self, market_name, order_side, amount, amount_currency, schedule=None):
+        # Journal the intent before anything is sent so a crash mid-submission leaves
+        #   a pending row to reconcile rather than no record at all.
+        order = Order.create(
+            schedule=schedule,
+            run_at=schedule.last_run if schedule else None,
+            credential=self.api_credential,
+            client_order_id=Order.new_client_order_id(),
+            market_name=market_name,
+            order_side=order_side,
+            amount=amount,
+            amount_currency=amount_currency,
+            raw_data={},
+            status=Order.STATUS__PENDING,
+            updated=datetime.datetime.now()
         )
+        self.submit_intent([order])
+        return order
 
 
-    def update_order(self, order):
-        result = self.api_conn.order_status(order.order_id)
+    def place_scheduled_orders(self, schedules):
+        """
+            Places a single limit order for the combined amount of `schedules` and
+            records one `Order` per schedule, each allocated its proportional share.
+            Combining also lets schedules that are individually below the market's
+            min order size go through.
+        """
+        if len(schedules) == 1:
+            return [self.place_scheduled_order(schedules[0])]
+
+        first = schedules[0]
+        total = sum(schedule.amount for schedule in schedules)
+        client_order_id = Order.new_client_order_id()
+        now = datetime.datetime.now()
+
+        orders = []
+        with db.atomic():
+            for schedule in schedules:
+                orders.append(Order.create(
+                    schedule=schedule,
+                    run_at=schedule.last_run,
+                    credential=self.api_credential,
+                    client_order_id=client_order_id,
+                    market_name=schedule.market_name,
+                    order_side=schedule.order_side,
+                    amount=schedule.amount,
+                    amount_currency=schedule.amount_currency,
+                    raw_data={},
+                    status=Order.STATUS__PENDING,
+                    updated=now,
+                    allocation=schedule.amount / total
+                ))
+
+        self.submit_intent(orders)
+        logger.info(f"Coalesced {len(schedules)} schedules into one {first.market_name} {first.order_side} order")
+        return orders
+
+
+    def submit_intent(self, orders):
+        """
+            Submits a journaled order (several rows if coalesced, all sharing one
+            `client_order_id`) and records the exchange's response on each row.
+
+            If it fails before anything reached the exchange the intent is deleted, as
+            there's nothing to reconcile, and the error re-raised.
+        """
+        first = orders[0]
+        total = sum(order.amount for order in orders)
+        try:
+            result, status, is_live = self.submit_order(
+                first.market_name, first.order_side, total, first.amount_currency,
+                client_order_id=first.client_order_id
+            )
+        except SubmissionOutcomeUnknown as e:
+            raise OrderSubmissionPending(orders, e.__cause__) from e.__cause__
+        except Exception:
+            Order.delete().where(Order.id.in_([order.id for order in orders])).execute()
+            raise
+        self.record_result(orders, result, status, is_live)
+
+
+    def record_result(self, orders, result, status, is_live):
+        summary = GeminiExchange.order_summary(result)
+        now = datetime.datetime.now()
+
+        with metrics.order_stage_seconds.time(stage="db_write"):
+            with db.atomic():
+                for order in orders:
+                    order.order_id = result.get("order_id")
+                    order.raw_data = result
+                    order.status = status
+                    order.is_live = is_live
+                    order.updated = now
+                    for field, value in GeminiExchange.allocate_summary(summary, order.allocation).items():
+                        setattr(order, field, value)
+                    order.save()
+        metrics.orders_placed_total.inc(exchange=GeminiExchange.exchange, status=status)
+
+        # Reset the schedule so it runs again
+        if status == Order.STATUS__REJECTED:
+            for order in orders:
+                if order.schedule_id:
+                    order.schedule.undo_last_run()
+
+
+    def reconcile_pending_orders(self, orders):
+        """
+            Resolves intents left pending by a crash or an ambiguous error: adopts the
+            exchange's record of the order if it has one, otherwise submits it now.
+        """
+        intents = {}
+        for order in orders:
+            intents.setdefault(order.client_order_id, []).append(order)
+
+        for client_order_id, intent in intents.items():
+            try:
+                result = self.api_conn.order_status(client_order_id=client_order_id)
+            except GeminiRequestException as e:
+                if e.response_json.get("reason") != "OrderNotFound":
+                    raise
+                result = None
+
+            if isinstance(result, list):
+                result = result[0] if result else None
+
+            if not result:
+                logger.info(f"Order {client_order_id} never reached the exchange; submitting it now")
+                self.submit_intent(intent)
+                continue
+
+            logger.info(f"Order {client_order_id} was accepted as {result.get('order_id')}; recording it")
+            status, is_live = GeminiExchange.new_order_status(result)
+            self.record_result(intent, result, status, is_live)
+            if status == Order.STATUS__OPEN:
+                # It may have filled or been cancelled since
+                for order in intent:
+                    self.apply_order_status(order, result)
+
+
+    @staticmethod
+    def order_summary(result):
+        """
+            Pulls the fields list views need out of an order status response so they
+            can be stored as real `Order` columns.
+        """
+        def to_decimal(value):
+            if value is None or value == "":
+                return None
+            return Decimal(str(value))
+
+        fee = None
+        if result.get("trades"):
+            fee = sum(Decimal(str(t.get("fee_amount", 0))) for t in result["trades"])
+
+        return {
+            "executed_amount": to_decimal(result.get("executed_amount")),
+            "avg_execution_price": to_decimal(result.get("avg_execution_price")),
+            "fee": fee,
+        }
 
+
+    @staticmethod
+    def allocate_summary(summary, allocation):
+        """
+            Scales a coalesced order's summary down to one schedule's share; the
+            average price is the same for every share.
+        """
+        if allocation is None:
+            return summary
+
+        allocated = dict(summary)
+        for field in ("executed_amount", "fee"):
+            if allocated[field] is not None:
+                allocated[field] = allocated[field] * allocation
+        return allocated
+
+
+    def apply_order_status(self, order, result):
         if result.get("is_cancelled"):
             order.status = Order.STATUS__CANCELLED
             order.is_live = False
@@ -289,6 +648,85 @@ class GeminiExchange(object):
             order.is_live = False
 
         order.raw_data = result
+        summary = GeminiExchange.allocate_summary(GeminiExchange.order_summary(result), order.allocation)
+        for field, value in summary.items():
+            setattr(order, field, value)
+        order.updated = datetime.datetime.now()
         order.save()
 
 
+    def update_order(self, order):
+        result = self.api_conn.order_status(order.order_id)
+        self.apply_order_status(order, result)
+
+
+    @staticmethod
+    def order_status_from_trades(order, trades):
+        """
+            Builds a completed order status from its fills. Returns None unless the
+            trades account for the full `original_amount`; partial fills could still be
+            live or cancelled so those need a real /order/status lookup.
+        """
+        original_amount = order.raw_data.get("original_amount")
+        if not trades or original_amount is None:
+            return None
+
+        executed_amount = sum(Decimal(t["amount"]) for t in trades)
+        if executed_amount < Decimal(original_amount):
+            return None
+
+        notional = sum(Decimal(t["amount"]) * Decimal(t["price"]) for t in trades)
+        result = dict(order.raw_data)
+        result.update({
+            "is_live": False,
+            "is_cancelled": False,
+            "executed_amount": str(executed_amount),
+            "remaining_amount": "0",
+            "avg_execution_price": str(notional / executed_amount),
+            "trades": trades,
+        })
+        return result
+
+
+    def update_orders(self, orders):
+        """
+            Reconciles every live `Order` for this credential using one /orders call
+            plus one /mytrades call per market; /order/status is only needed for
+            orders that left the active set without being fully explained by fills.
+        """
+        if not orders:
+            return
+
+        active = {str(o["order_id"]): o for o in self.api_conn.active_orders()}
+
+        missing = [o for o in orders if o.order_id not in active]
+        trades_by_order = {}
+        for market_name in set(o.market_name for o in missing):
+            since = min(o.created for o in missing if o.market_name == market_name)
+            for trade in self.api_conn.my_trades(market_name, since=since):
+                trades_by_order.setdefault(str(trade["order_id"]), []).append(trade)
+
+        # Coalesced orders have several rows per exchange order; only look each up once
+        statuses = {}
+        results = []
+        for order in orders:
+            if order.order_id in active:
+                result = active[order.order_id]
+            elif order.order_id in statuses:
+                result = statuses[order.order_id]
+            else:
+                result = self.order_status_from_trades(order, trades_by_order.get(order.order_id))
+                if result is None:
+                    result = self.api_conn.order_status(order.order_id)
+                statuses[order.order_id] = result
+
+            # Nothing to write for resting orders that haven't changed
+            if result != order.raw_data:
+                results.append((order, result))
+
+        with metrics.order_stage_seconds.time(stage="status_update"):
+            with db.atomic():
+                for order, result in results:
+                    self.apply_order_status(order, result)
+
+
@@ -0,0 +1,192 @@
+import json
+import logging
+import threading
+import time
+
+from decimal import Decimal
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def _import_websocket():
+    # websocket-client pulls in ssl; only load it once streaming is actually enabled
+    try:
+        import websocket
+    except ImportError:
+        # Optional; without websocket-client pricing always falls back to REST
+        return None
+    return websocket
+
+
+
+class GeminiTopOfBookFeed(object):
+    """
+        Keeps the best bid/ask for a single market in memory, fed by Gemini's v1
+        market data websocket in top-of-book mode.
+
+        Message format:
+            {
+                "type": "update",
+                "socket_sequence": 1,
+                "events": [
+                    {
+                        "type": "change",
+                        "side": "bid",
+                        "price": "3607.85",
+                        "remaining": "6.643373",
+                        "reason": "top-of-book"
+                    },
+                    ...,
+                ]
+            }
+    """
+    ws_base_url = "wss://api.gemini.com/v1/marketdata"
+
+    # Seconds to wait before reconnecting after the socket drops
+    RECONNECT_DELAY = 2
+
+    def __init__(self, market_name: str, ws_base_url: str = None):
+        self.market_name = market_name
+        if ws_base_url:
+            self.ws_base_url = ws_base_url
+        self.bid = None
+        self.ask = None
+        self.last_message = None
+        self._lock = threading.Lock()
+        self._ws = None
+        self._running = False
+        self._thread = None
+
+
+    @property
+    def url(self):
+        return f"{self.ws_base_url}/{self.market_name}?top_of_book=true&heartbeat=true&trades=false"
+
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"market_data_{self.market_name}")
+        self._thread.start()
+
+
+    def stop(self):
+        self._running = False
+        if self._ws:
+            self._ws.close()
+
+
+    def _run(self):
+        websocket = _import_websocket()
+        while self._running:
+            self._ws = websocket.WebSocketApp(
+                self.url,
+                on_message=self._on_message,
+                on_close=self._on_close,
+            )
+            self._ws.run_forever()
+            if self._running:
+                time.sleep(self.RECONNECT_DELAY)
+
+
+    def _on_close(self, ws, *args):
+        # Don't price off a book we're no longer receiving updates for
+        with self._lock:
+            self.bid = None
+            self.ask = None
+            self.last_message = None
+
+
+    def _on_message(self, ws, message):
+        data = json.loads(message)
+        with self._lock:
+            self.last_message = time.monotonic()
+            for event in data.get("events", []):
+                if event.get("type") != "change":
+                    continue
+
+                price = Decimal(event["price"])
+                remaining = Decimal(event["remaining"])
+                side = event.get("side")
+                if side == "bid":
+                    if remaining > 0:
+                        self.bid = price
+                    elif price == self.bid:
+                        self.bid = None
+                elif side == "ask":
+                    if remaining > 0:
+                        self.ask = price
+                    elif price == self.ask:
+                        self.ask = None
+
+
+    def top_of_book(self, max_age: float):
+        """
+            Returns `(bid, ask)` or None if the feed isn't current.
+        """
+        with self._lock:
+            if self.bid is None or self.ask is None or self.last_message is None:
+                return None
+            if time.monotonic() - self.last_message > max_age:
+                return None
+            return (self.bid, self.ask)
+
+
+
+class MarketDataManager(object):
+    """
+        Process-wide registry of live top-of-book feeds, one per market, so every
+        schedule on the same market shares a single subscription. Disabled by default;
+        callers get None and should fall back to a REST order book request.
+    """
+    # Gemini sends heartbeats every 5s so anything older means the feed has stalled
+    DEFAULT_MAX_AGE = 10
+
+    def __init__(self):
+        self.enabled = False
+        self.ws_base_url = None
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+
+    @property
+    def is_available(self):
+        return _import_websocket() is not None
+
+
+    def enable(self, ws_base_url: str = None):
+        if not self.is_available:
+            logger.warning("websocket-client not installed; market data streaming disabled")
+            return
+        self.ws_base_url = ws_base_url
+        self.enabled = True
+
+
+    def disable(self):
+        self.enabled = False
+        with self._lock:
+            for feed in self._feeds.values():
+                feed.stop()
+            self._feeds = {}
+
+
+    def get_top_of_book(self, market_name: str, max_age: float = DEFAULT_MAX_AGE):
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            feed = self._feeds.get(market_name)
+            if not feed:
+                # Subscribe on first use; this request still falls back to REST while
+                #   the feed warms up.
+                feed = GeminiTopOfBookFeed(market_name, ws_base_url=self.ws_base_url)
+                feed.start()
+                self._feeds[market_name] = feed
+
+        return feed.top_of_book(max_age)
+
+
+
+gemini_market_data = MarketDataManager()
@@ -0,0 +1,71 @@
+import threading
+import time
+
+
+
+class TokenBucket(object):
+    """
+        Thread-safe token bucket that queues callers instead of failing them.
+
+        Each `acquire()` reserves a token immediately (the balance may go negative) and
+        then sleeps outside the lock until that reservation is covered, so waiting
+        callers are served roughly in arrival order at exactly `rate` per second.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def _refill(self):
+        # Must be called while holding the lock
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+    def acquire(self):
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+    def try_acquire(self):
+        """
+            Non-blocking: takes a token and returns 0 if one is available, otherwise
+            returns the seconds until one will be (without reserving it).
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+
+class RateLimiter(object):
+    """
+        One `TokenBucket` per key (e.g. per API key), created on first use.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+
+    def acquire(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if not bucket:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self._buckets[key] = bucket
+        return bucket.acquire()
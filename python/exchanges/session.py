@@ -0,0 +1,90 @@
+import threading
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+
+# A single keep-alive `requests.Session` is shared by every exchange API connection in
+#   the process so consecutive calls reuse pooled TCP+TLS connections instead of paying
+#   the handshake cost on each request.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (5, 30)       # (connect, read) seconds
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_config = {
+    "pool_size": DEFAULT_POOL_SIZE,
+    "timeout": DEFAULT_TIMEOUT,
+    "retries": DEFAULT_RETRIES,
+    "backoff_factor": DEFAULT_BACKOFF_FACTOR,
+}
+_session = None
+_lock = threading.Lock()
+
+
+
+def _build_session():
+    # Only idempotent GETs are retried automatically. Signed POSTs carry a nonce that
+    #   can't be replayed, so callers retry those themselves with a fresh nonce.
+    retry = Retry(
+        total=_config["retries"],
+        backoff_factor=_config["backoff_factor"],
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=_config["pool_size"],
+        pool_maxsize=_config["pool_size"],
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+
+def configure_session(pool_size: int = None, timeout=None, retries: int = None, backoff_factor: float = None):
+    """
+        Updates the shared session settings; the pool is rebuilt on next use.
+    """
+    global _session
+    with _lock:
+        if pool_size is not None:
+            _config["pool_size"] = pool_size
+        if timeout is not None:
+            _config["timeout"] = timeout
+        if retries is not None:
+            _config["retries"] = retries
+        if backoff_factor is not None:
+            _config["backoff_factor"] = backoff_factor
+
+        if _session:
+            _session.close()
+        _session = None
+
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = _build_session()
+        return _session
+
+
+
+def get_timeout():
+    return _config["timeout"]
+
+
+
+def get_retry_config():
+    return _config["retries"], _config["backoff_factor"]
@@ -0,0 +1,70 @@
+import datetime
+import threading
+
+from models import SymbolDetails
+
+
+
+class SymbolDetailsCache(object):
+    """
+        Process-wide, sqlite-backed cache of an exchange's per-market symbol details.
+
+        Tick size, quote increment, and min order size almost never change so there's
+        no need to spend a round trip (and public rate limit budget) on every order.
+        Entries expire after `ttl` and are dropped early via `invalidate()` when the
+        exchange rejects an order in a way that suggests the details are stale.
+    """
+    DEFAULT_TTL = datetime.timedelta(hours=6)
+
+    def __init__(self, exchange: str, ttl: datetime.timedelta = DEFAULT_TTL):
+        self.exchange = exchange
+        self.ttl = ttl
+        self._entries = {}  # market_name -> (raw_data, updated)
+        self._lock = threading.Lock()
+
+
+    def _is_fresh(self, updated):
+        return datetime.datetime.now() - updated < self.ttl
+
+
+    def get(self, market_name: str, fetch):
+        """
+            Returns the cached details for `market_name`, falling back to the db and
+            finally to `fetch(market_name)` when nothing fresh is available.
+        """
+        with self._lock:
+            entry = self._entries.get(market_name)
+        if entry and self._is_fresh(entry[1]):
+            return entry[0]
+
+        stored = SymbolDetails.get_or_none(
+            (SymbolDetails.exchange == self.exchange) & (SymbolDetails.market_name == market_name)
+        )
+        if stored and self._is_fresh(stored.updated):
+            with self._lock:
+                self._entries[market_name] = (stored.raw_data, stored.updated)
+            return stored.raw_data
+
+        raw_data = fetch(market_name)
+        updated = datetime.datetime.now()
+        SymbolDetails.insert(
+            exchange=self.exchange,
+            market_name=market_name,
+            raw_data=raw_data,
+            updated=updated
+        ).on_conflict(
+            conflict_target=[SymbolDetails.exchange, SymbolDetails.market_name],
+            update={SymbolDetails.raw_data: raw_data, SymbolDetails.updated: updated}
+        ).execute()
+
+        with self._lock:
+            self._entries[market_name] = (raw_data, updated)
+        return raw_data
+
+
+    def invalidate(self, market_name: str):
+        with self._lock:
+            self._entries.pop(market_name, None)
+        SymbolDetails.delete().where(
+            (SymbolDetails.exchange == self.exchange) & (SymbolDetails.market_name == market_name)
+        ).execute()
@@ -0,0 +1,176 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+
+# Minimal in-process metrics (counters, gauges, histograms) rendered in the Prometheus
+#   text exposition format by the `/metrics` route.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+
+def _format_labels(label_key, extra=None):
+    pairs = list(label_key) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+
+class Metric(object):
+    type_name = None
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        with self._lock:
+            for label_key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(label_key, value))
+        return lines
+
+
+    def _render_value(self, label_key, value):
+        return [f"{self.name}{_format_labels(label_key)} {value}"]
+
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = list(counts)
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+    def _render_value(self, label_key, value):
+        counts, total, count = value
+        lines = []
+        for upper_bound, bucket_count in zip(self.buckets, counts):
+            lines.append(f"{self.name}_bucket{_format_labels(label_key, [('le', upper_bound)])} {bucket_count}")
+        lines.append(f"{self.name}_bucket{_format_labels(label_key, [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(label_key)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(label_key)} {count}")
+        return lines
+
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = []
+
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+
+registry = MetricsRegistry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+
+def start_metrics_server(port: int):
+    """
+        Serves `/metrics` from a background thread; for when the daemon runs as its own
+        process and the Flask server's route can't see its metrics.
+    """
+    # Only needed with `--metrics-port`; http.server pulls in http.client and ssl
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+
+schedule_scan_seconds = registry.register(Histogram(
+    "bonsai_schedule_scan_seconds", "Time spent loading runnable schedules into the scheduler queue"))
+schedule_fire_lag_seconds = registry.register(Histogram(
+    "bonsai_schedule_fire_lag_seconds", "Delay between a schedule's due time and when it was dispatched"))
+order_stage_seconds = registry.register(Histogram(
+    "bonsai_order_stage_seconds", "Time spent in each stage of placing or updating an order"))
+exchange_api_seconds = registry.register(Histogram(
+    "bonsai_exchange_api_seconds", "Exchange API request latency by endpoint"))
+exchange_api_requests_total = registry.register(Counter(
+    "bonsai_exchange_api_requests_total", "Exchange API requests by endpoint and HTTP status"))
+orders_placed_total = registry.register(Counter(
+    "bonsai_orders_placed_total", "Orders placed by exchange and resulting status"))
+live_orders = registry.register(Gauge(
+    "bonsai_live_orders", "Orders still live on the exchange at the last reconciliation"))
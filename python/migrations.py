@@ -0,0 +1,189 @@
+"""
+    Versioned schema migrations for existing ~/.bonsai_dca/data.db files.
+
+    The current version is kept in sqlite's `PRAGMA user_version` (0 for any db
+    created before migrations existed). Fresh installs build the latest schema straight
+    from the models and skip the migrations entirely, so any change to a model must
+    also be added here as a new numbered migration.
+"""
+import logging
+
+from playhouse.migrate import SqliteMigrator, migrate
+
+from models import db, MODELS, ArchivedOrder, ChangeEvent, DCASchedule, Fill, Order, PriceSnapshot, SymbolDetails
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def migration_0001_hot_query_indexes(migrator):
+    # SymbolDetails was added before migrations existed
+    db.create_tables([SymbolDetails], safe=True)
+
+    migrate(
+        migrator.add_index('order', ('is_live', 'order_id'), False),
+        migrator.add_index('order', ('credential_id', 'created'), False),
+        migrator.add_index('dcaschedule', ('is_paused', 'is_active'), False),
+    )
+
+
+
+def migration_0002_order_summary_columns(migrator):
+    from exchanges.gemini import GeminiExchange
+
+    migrate(
+        migrator.add_column('order', 'executed_amount', Order.executed_amount),
+        migrator.add_column('order', 'avg_execution_price', Order.avg_execution_price),
+        migrator.add_column('order', 'fee', Order.fee),
+    )
+
+    # Backfill from the stored exchange responses. Collect first; updating rows while
+    #   the select cursor is still open isn't safe in sqlite.
+    summaries = []
+    for order_id, raw_data in Order.select(Order.id, Order.raw_data).tuples().iterator():
+        summary = GeminiExchange.order_summary(raw_data or {})
+        if any(v is not None for v in summary.values()):
+            summaries.append((order_id, summary))
+
+    for order_id, summary in summaries:
+        Order.update(**summary).where(Order.id == order_id).execute()
+
+
+
+def migration_0003_schedule_leases(migrator):
+    migrate(
+        migrator.add_column('dcaschedule', 'lease_owner', DCASchedule.lease_owner),
+        migrator.add_column('dcaschedule', 'lease_expires', DCASchedule.lease_expires),
+    )
+
+
+
+def migration_0004_order_allocation(migrator):
+    migrate(
+        migrator.add_column('order', 'allocation', Order.allocation),
+    )
+
+
+
+def create_table_as_of(migrator, model, indexes):
+    """
+        Creates `model`'s table with only `indexes` (the ones it had when the migration
+        was written), rather than the live model's. An index added to the model later
+        comes with its own migration, which would fail if the index already existed.
+    """
+    model._schema.create_table()
+    migrate(*[
+        migrator.add_index(model._meta.table_name, columns, unique)
+        for columns, unique in indexes
+    ])
+
+
+
+def migration_0005_analytics_tables(migrator):
+    # Populated by the daemon's next `analytics.sync_fills()`
+    create_table_as_of(migrator, Fill, [
+        (('order_id',), True),
+        (('credential_id',), False),
+        (('schedule_id',), False),
+        (('credential_id', 'schedule_id'), False),
+    ])
+    create_table_as_of(migrator, PriceSnapshot, [
+        (('exchange', 'market_name', 'timestamp'), False),
+    ])
+
+
+
+def migration_0006_change_feed(migrator):
+    db.create_tables([ChangeEvent])
+
+
+
+def migration_0007_order_intent_journal(migrator):
+    migrate(
+        migrator.add_column('order', 'client_order_id', Order.client_order_id),
+        migrator.add_index('order', ('client_order_id',), False),
+        migrator.add_index('order', ('status', 'updated'), False),
+    )
+
+
+
+def migration_0008_schedule_catch_up_policy(migrator):
+    migrate(
+        migrator.add_column('dcaschedule', 'catch_up_policy', DCASchedule.catch_up_policy),
+    )
+
+
+
+def migration_0009_order_archive(migrator):
+    # Filled by the daemon's periodic `archive.archive_orders()`
+    create_table_as_of(migrator, ArchivedOrder, [
+        (('schedule_id',), False),
+        (('credential_id',), False),
+        (('credential_id', 'created'), False),
+    ])
+
+
+
+def migration_0010_fill_lot_index(migrator):
+    migrate(
+        migrator.add_index('fill', ('credential_id', 'market_name', 'filled_at'), False),
+    )
+
+
+
+def migration_0011_order_run_at(migrator):
+    migrate(
+        migrator.add_column('order', 'run_at', Order.run_at),
+    )
+
+
+
+MIGRATIONS = [
+    (1, migration_0001_hot_query_indexes),
+    (2, migration_0002_order_summary_columns),
+    (3, migration_0003_schedule_leases),
+    (4, migration_0004_order_allocation),
+    (5, migration_0005_analytics_tables),
+    (6, migration_0006_change_feed),
+    (7, migration_0007_order_intent_journal),
+    (8, migration_0008_schedule_catch_up_policy),
+    (9, migration_0009_order_archive),
+    (10, migration_0010_fill_lot_index),
+    (11, migration_0011_order_run_at),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+
+def get_schema_version():
+    return db.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+
+def set_schema_version(version: int):
+    db.execute_sql(f"PRAGMA user_version = {int(version)}")
+
+
+
+def migrate_database():
+    with db.connection_context():
+        if not db.table_exists('apicredential'):
+            # Fresh install
+            with db.atomic():
+                db.create_tables(MODELS)
+                set_schema_version(SCHEMA_VERSION)
+            return
+
+        migrator = SqliteMigrator(db)
+        version = get_schema_version()
+        for target_version, migration in MIGRATIONS:
+            if target_version <= version:
+                continue
+
+            logger.info(f"Migrating database to schema version {target_version}")
+            with db.atomic():
+                migration(migrator)
+                set_schema_version(target_version)
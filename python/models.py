@@ -1,41 +1,90 @@
 import datetime
-import dateutil
+import json
 import os
+import uuid
+import zlib
 
 from decimal import Decimal
 from pathlib import Path
 from peewee import *
-from playhouse.shortcuts import model_to_dict
 from playhouse.sqlite_ext import JSONField
 
+from serializers import ModelSerializer
+
 
 
 data_dir = os.path.join(Path.home(), ".bonsai_dca")
-Path(data_dir).mkdir(parents=True, exist_ok=True)
 DATABASE = os.path.join(data_dir, "data.db")
 
+# The server and the daemon (thread or separate process) write to the same file at
+#   the same time. WAL lets readers proceed while a write is in progress and
+#   synchronous=NORMAL is still crash-safe in WAL mode.
+DATABASE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16 * 1024,           # KiB when negative, so 16MB
+    'mmap_size': 64 * 1024 * 1024,
+    'busy_timeout': 10 * 1000,          # ms to wait on a locked db before failing
+}
+
+class BonsaiDatabase(SqliteDatabase):
+    # Creates the db's directory on the first connection rather than when this module
+    #   is imported, so importing it has no side effects and costs no disk access.
+    _dir_created = False
+
+    def _connect(self):
+        if not self._dir_created:
+            Path(os.path.dirname(os.path.abspath(self.database))).mkdir(parents=True, exist_ok=True)
+            self._dir_created = True
+        return super()._connect()
+
+    def init(self, database, *args, **kwargs):
+        self._dir_created = False
+        super().init(database, *args, **kwargs)
+
+
+
 # Create a database instance that will manage the connection and
-# execute queries
-db = SqliteDatabase(DATABASE)
+# execute queries. Connections are per-thread; the Flask server opens/closes one per
+# request and the daemon's workers do the same per order.
+db = BonsaiDatabase(DATABASE, pragmas=DATABASE_PRAGMAS)
+
+# A pending Order (intent journaled but no result recorded) younger than this may still
+#   be mid-submission on some worker, so it's left alone. Must exceed the longest time
+#   an order submission can take, including rate limiting and retries.
+PENDING_ORDER_GRACE = 120
+
+# Once a submission has failed nothing is placing the intent any more, so it only waits
+#   this long (for the exchange to settle) before being reconciled
+FAILED_SUBMISSION_GRACE = 15
+
+
+
+def configure_database(database: str = None, **pragmas):
+    """
+        Points `db` at a different file (e.g. for benchmarks) and/or overrides any of the
+        default `DATABASE_PRAGMAS`. Must be called before the first connection is opened.
+    """
+    db.init(database or DATABASE, pragmas={**DATABASE_PRAGMAS, **pragmas})
 
 
 
 def create_tables():
-    # Called on every launch
-    def table_exists(name):
-        with db:
-            c = db.cursor()
-            c.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{name}'")
-            result = c.fetchone()
-            return result is not None and name in result 
+    # Called on every launch. Creates the tables on a fresh install, otherwise brings
+    #   an existing data.db up to the current schema version.
+    from migrations import migrate_database
+    migrate_database()
+
 
-    with db:
-        if not table_exists('apicredential'):
-            db.create_tables([APICredential])
-        if not table_exists('dcaschedule'):
-            db.create_tables([DCASchedule])
-        if not table_exists('order'):
-            db.create_tables([Order])
+
+def iterate_query(query):
+    """
+        Yields a query's rows without caching them, for streamed responses. Those are
+        generated after the request's connection has been closed, so this holds its own
+        for the duration.
+    """
+    with db.connection_context():
+        yield from query.iterator()
 
 
 
@@ -51,6 +100,7 @@ class APICredential(BaseModel):
     EXCHANGE__COINBASE = 'coinbase'
     EXCHANGE__GEMINI = 'gemini'
     EXCHANGE__PAXOS = 'paxos'
+    EXCHANGE__FAKE = 'fake'         # In-process simulated exchange for load testing
 
     exchange = CharField()
     client_key = CharField()
@@ -75,6 +125,11 @@ class DCASchedule(BaseModel):
     HOURS = "hour(s)"
     MINUTES = "minute(s)"
 
+    # What to do about runs missed while the daemon wasn't running
+    CATCH_UP__SKIP = "skip"         # drop them and resume on the normal cadence
+    CATCH_UP__ONCE = "once"         # run once now
+    CATCH_UP__EACH = "each"         # run once for every missed period, spread out
+
     credential = ForeignKeyField(APICredential, backref='schedules')
     is_active = BooleanField(default=True)
     is_paused = BooleanField(default=False)
@@ -86,6 +141,26 @@ class DCASchedule(BaseModel):
     repeat_timescale = CharField()
     created = DateTimeField(default=datetime.datetime.now)
     last_run = DateTimeField(null=True)
+    catch_up_policy = CharField(default=CATCH_UP__ONCE)
+
+    # Set while a daemon is placing this schedule's order; see `claim_run`
+    lease_owner = CharField(null=True)
+    lease_expires = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('is_paused', 'is_active'), False),
+        )
+
+    @property
+    def repeat_interval(self):
+        if self.repeat_timescale == DCASchedule.DAYS:
+            return datetime.timedelta(days=self.repeat_duration)
+        elif self.repeat_timescale == DCASchedule.HOURS:
+            return datetime.timedelta(hours=self.repeat_duration)
+        else:
+            return datetime.timedelta(minutes=self.repeat_duration)
+
 
     @property
     def next_run(self):
@@ -93,38 +168,142 @@ class DCASchedule(BaseModel):
         if not last_run:
             last_run = datetime.datetime.now()
 
-        if self.repeat_timescale == DCASchedule.DAYS:
-            td = datetime.timedelta(days=self.repeat_duration)
-        elif self.repeat_timescale == DCASchedule.HOURS:
-            td = datetime.timedelta(hours=self.repeat_duration)
-        else:
-            td = datetime.timedelta(minutes=self.repeat_duration)
-
-        return last_run + td
+        return last_run + self.repeat_interval
 
     @property
     def is_time_to_run(self):
+        return self.is_due_by(datetime.datetime.now())
+
+
+    def is_due_by(self, when):
         if not self.is_active:
             return False
 
         if not self.last_run:
             return True
 
-        return datetime.datetime.now() > self.next_run
+        return when > self.next_run
 
     def undo_last_run(self):
-        if self.repeat_timescale == DCASchedule.DAYS:
-            td = datetime.timedelta(days=self.repeat_duration)
-        elif self.repeat_timescale == DCASchedule.HOURS:
-            td = datetime.timedelta(hours=self.repeat_duration)
+        # Puts the period just claimed back so the schedule is due again
+        self.last_run -= self.repeat_interval
+        self.save(only=[DCASchedule.last_run])
+
+
+    def missed_periods(self, now):
+        """
+            Whole periods that have come due since `last_run` (1 when simply due).
+        """
+        if not self.last_run:
+            return 0
+        return int((now - self.last_run) / self.repeat_interval)
+
+
+    def _update_if_unclaimed(self, **updates):
+        # Compare-and-set: only applies if `last_run` is still what we read and no
+        #   daemon holds the lease.
+        if self.last_run is None:
+            unchanged = DCASchedule.last_run.is_null()
         else:
-            td = datetime.timedelta(minutes=self.repeat_duration)
-        self.last_run - td
-        self.save()
+            unchanged = (DCASchedule.last_run == self.last_run)
+
+        return DCASchedule.update(**updates).where(
+            (DCASchedule.id == self.id) & unchanged & DCASchedule.lease_owner.is_null()
+        ).execute() > 0
+
+
+    def claim_run(self, owner: str, lease_seconds: float, run_at=None):
+        """
+            Atomically marks a period as run (`run_at`, default now) and leases the
+            schedule to `owner`. Only succeeds if `last_run` is still what we read and
+            no other daemon holds the lease, so when several daemons race for the same
+            period exactly one of them wins.
+        """
+        now = datetime.datetime.now()
+        run_at = run_at or now
+        expires = now + datetime.timedelta(seconds=lease_seconds)
+
+        if not self._update_if_unclaimed(last_run=run_at, lease_owner=owner, lease_expires=expires):
+            return False
+
+        self.last_run = run_at
+        self.lease_owner = owner
+        self.lease_expires = expires
+        return True
+
+
+    def skip_missed_runs(self, now):
+        """
+            Moves `last_run` up to the latest period boundary without placing anything.
+        """
+        run_at = self.last_run + self.repeat_interval * self.missed_periods(now)
+        if not self._update_if_unclaimed(last_run=run_at):
+            return False
+
+        self.last_run = run_at
+        return True
+
+
+    def take_over_lease(self, owner: str, lease_seconds: float):
+        """
+            Steals an expired lease (e.g. its daemon crashed mid-order). Compares
+            against the lease we read so only one daemon can take it over.
+        """
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=lease_seconds)
+        claimed = DCASchedule.update(
+            lease_owner=owner,
+            lease_expires=expires
+        ).where(
+            (DCASchedule.id == self.id) &
+            (DCASchedule.lease_owner == self.lease_owner) &
+            (DCASchedule.lease_expires == self.lease_expires) &
+            (DCASchedule.lease_expires < now)
+        ).execute()
+
+        if claimed:
+            self.lease_owner = owner
+            self.lease_expires = expires
+        return bool(claimed)
+
+
+    def release_lease(self, owner: str):
+        DCASchedule.update(
+            lease_owner=None,
+            lease_expires=None
+        ).where(
+            (DCASchedule.id == self.id) & (DCASchedule.lease_owner == owner)
+        ).execute()
+        self.lease_owner = None
+        self.lease_expires = None
+
+
+    @classmethod
+    def expired_leases(cls):
+        return cls.select().where(
+            cls.lease_owner.is_null(False) & (cls.lease_expires < datetime.datetime.now())
+        )
+
+
+    @property
+    def has_order_for_last_run(self):
+        """
+            Keyed on the period itself: when catching up (`CATCH_UP__EACH`) `last_run`
+            is a past boundary, so the order for the previous period was also created
+            after it.
+        """
+        if not self.last_run:
+            return False
+        return self.orders.where(
+            (Order.run_at == self.last_run) |
+            # Journaled before orders recorded their period
+            (Order.run_at.is_null() & (Order.created >= self.last_run))
+        ).exists()
 
 
 
 class Order(BaseModel):
+    STATUS__PENDING = 'pending'
     STATUS__OPEN = 'open'
     STATUS__INSUFFICIENT_FUNDS = 'insufficient funds'
     STATUS__MIN_ORDER_SIZE = 'min order size not met'
@@ -135,6 +314,7 @@ class Order(BaseModel):
     schedule = ForeignKeyField(DCASchedule, backref='orders', null=True)
     credential = ForeignKeyField(APICredential, backref='orders')
     order_id = CharField(null=True)     # Null if order attempt fails
+    client_order_id = CharField(null=True)
     status = CharField(default=STATUS__OPEN)
     market_name = CharField()
     order_side = CharField()
@@ -145,10 +325,203 @@ class Order(BaseModel):
     created = DateTimeField(default=datetime.datetime.now)
     updated = DateTimeField(null=True)
 
+    # Broken out of `raw_data` whenever it's written so list views never have to
+    #   deserialize the full exchange response.
+    executed_amount = DecimalField(max_digits=24, decimal_places=12, null=True)
+    avg_execution_price = DecimalField(max_digits=24, decimal_places=12, null=True)
+    fee = DecimalField(max_digits=24, decimal_places=12, null=True)
+
+    # Set when several schedules were coalesced into one exchange order: this row's
+    #   share of it. The rows share `order_id` and `raw_data`; the summary columns
+    #   above hold only this row's share.
+    allocation = DecimalField(max_digits=24, decimal_places=12, null=True)
+
+    # The schedule period (`DCASchedule.last_run` as claimed) this order was placed for
+    run_at = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('is_live', 'order_id'), False),
+            (('credential', 'created'), False),
+            (('client_order_id',), False),
+            (('status', 'updated'), False),
+        )
+
+
+    @classmethod
+    def select_summary(cls, *extra):
+        """
+            Selects every column except `raw_data`.
+        """
+        return cls.select(*[f for f in cls._meta.sorted_fields if f is not cls.raw_data], *extra)
+
+
+    @staticmethod
+    def new_client_order_id():
+        return f"bonsai-{uuid.uuid4().hex}"
+
+
+    @classmethod
+    def claim_pending(cls, client_order_id: str, stale_before):
+        """
+            Intents whose submission never recorded a result are reconciled by whichever
+            daemon claims them first. Bumping `updated` is the claim; returns False if
+            another daemon already did.
+        """
+        return cls.update(
+            updated=datetime.datetime.now()
+        ).where(
+            (cls.client_order_id == client_order_id) &
+            (cls.status == cls.STATUS__PENDING) &
+            (cls.updated < stale_before)
+        ).execute() > 0
+
+
+    @classmethod
+    def release_pending(cls, orders):
+        """
+            Hands intents whose submission failed over to the daemon's reconciler early:
+            backdates them so they're picked up `FAILED_SUBMISSION_GRACE` from now
+            rather than after the full `PENDING_ORDER_GRACE`.
+        """
+        updated = datetime.datetime.now() - datetime.timedelta(seconds=PENDING_ORDER_GRACE - FAILED_SUBMISSION_GRACE)
+        client_order_ids = list(set(order.client_order_id for order in orders))
+        cls.update(
+            updated=updated
+        ).where(
+            cls.client_order_id.in_(client_order_ids) & (cls.status == cls.STATUS__PENDING)
+        ).execute()
+
+
+    def to_json(self):
+        return ORDER_SERIALIZER.to_dict(self)
+
+
+
+class ArchivedOrder(BaseModel):
+    """
+        Append-only cold store for terminal orders that are old enough that nothing will
+        update them again; moved out of `Order` by `archive.archive_orders`. Keeps the
+        original `Order.id` and summary columns, but `raw_data` is stored as compressed
+        JSON and only decoded when an order is viewed.
+    """
+    id = IntegerField(primary_key=True)     # the original Order.id
+    schedule = ForeignKeyField(DCASchedule, backref='archived_orders', null=True)
+    credential = ForeignKeyField(APICredential, backref='archived_orders')
+    order_id = CharField(null=True)
+    client_order_id = CharField(null=True)
+    status = CharField()
+    market_name = CharField()
+    order_side = CharField()
+    amount = DecimalField()
+    amount_currency = CharField()
+    created = DateTimeField()
+    updated = DateTimeField(null=True)
+    executed_amount = DecimalField(max_digits=24, decimal_places=12, null=True)
+    avg_execution_price = DecimalField(max_digits=24, decimal_places=12, null=True)
+    fee = DecimalField(max_digits=24, decimal_places=12, null=True)
+    allocation = DecimalField(max_digits=24, decimal_places=12, null=True)
+    compressed_raw_data = BlobField()
+    archived = DateTimeField(default=datetime.datetime.now)
+
+    # Only terminal orders are archived
+    is_live = False
+
+    class Meta:
+        indexes = (
+            (('credential', 'created'), False),
+        )
+
+
+    @staticmethod
+    def compress(raw_json: str):
+        return zlib.compress(raw_json.encode(), 9)
+
+
+    @property
+    def raw_data(self):
+        return json.loads(zlib.decompress(self.compressed_raw_data))
+
 
     def to_json(self):
-        data = model_to_dict(self, recurse=False)
-        data["amount"] = float(self.amount)  # Must convert Decimal fields
-        return data
+        return ARCHIVED_ORDER_SERIALIZER.to_dict(self)
+
+
+
+class SymbolDetails(BaseModel):
+    """
+        Persistent copy of an exchange's market metadata (tick size, quote increment,
+        min order size, etc) so it survives restarts. See `exchanges.symbol_cache`.
+    """
+    exchange = CharField()
+    market_name = CharField()
+    raw_data = JSONField()
+    updated = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('exchange', 'market_name'), True),
+        )
+
+
+
+class Fill(BaseModel):
+    """
+        Compact, analytics-only copy of every executed order: plain floats, no JSON, so
+        cost basis and P&L can be summed in SQL. Populated in the background from
+        `Order`'s summary columns by `analytics.sync_fills`.
+    """
+    order = ForeignKeyField(Order, unique=True)
+    credential = ForeignKeyField(APICredential)
+    schedule = ForeignKeyField(DCASchedule, null=True)
+    market_name = CharField()
+    is_buy = BooleanField()
+    quantity = FloatField()
+    notional = FloatField()         # quantity * avg execution price, in the quote currency
+    fee = FloatField(default=0)
+    filled_at = DateTimeField()
+
+    class Meta:
+        indexes = (
+            (('credential', 'schedule'), False),
+            # Tax lots stream each market's fills in time order; see `taxlots`
+            (('credential', 'market_name', 'filled_at'), False),
+        )
+
+
+
+class PriceSnapshot(BaseModel):
+    """
+        Periodic mid-market price for each market with an active schedule; used to
+        value open positions and as the benchmark for DCA performance.
+    """
+    exchange = CharField()
+    market_name = CharField()
+    price = FloatField()
+    timestamp = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('exchange', 'market_name', 'timestamp'), False),
+        )
+
+
+
+class ChangeEvent(BaseModel):
+    """
+        Short-lived change feed so a daemon running as a separate process can push
+        events to the server's `/events` stream. See `events.EventBus`.
+    """
+    event_type = CharField()
+    payload = TextField()           # already-serialized JSON
+    created = DateTimeField(default=datetime.datetime.now, index=True)
+
+
+
+ORDER_SERIALIZER = ModelSerializer(Order, exclude=[Order.raw_data])
+ARCHIVED_ORDER_SERIALIZER = ModelSerializer(ArchivedOrder, exclude=[ArchivedOrder.compressed_raw_data, ArchivedOrder.archived])
+
 
 
+# Every table, in dependency order
+MODELS = [APICredential, DCASchedule, Order, ArchivedOrder, SymbolDetails, Fill, PriceSnapshot, ChangeEvent]
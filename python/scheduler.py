@@ -0,0 +1,153 @@
+import datetime
+import heapq
+import threading
+
+from models import DCASchedule
+
+
+
+class ScheduleQueue(object):
+    """
+        Min-heap of upcoming `DCASchedule` fire times.
+
+        The daemon sleeps until the earliest entry is due instead of rescanning every
+        schedule on a fixed interval. Anything that changes the set of runnable
+        schedules (create, pause, unpause, delete) must call `wake()` so the heap is
+        rebuilt and the sleeping daemon re-evaluates its timeout.
+
+        Heap entries are `(next_run, schedule_id, generation)`; rebuilding bumps the
+        generation so stale entries left in the heap are discarded lazily on pop.
+
+        When several daemons share the db each one owns the schedules where
+        `id % shard_count == shard_index`. With `steal_after` set, the others' schedules
+        are queued too but only come due that many seconds late, so a dead shard's
+        schedules still run; whoever fires first wins `DCASchedule.claim_run` and the
+        rest see the new `last_run` and requeue.
+    """
+    def __init__(self):
+        self._heap = []
+        self._generation = 0
+        self._needs_reload = True
+        self._cond = threading.Condition()
+        self.shard_index = 0
+        self.shard_count = 1
+        self.steal_after = None
+
+
+    def configure_shard(self, shard_index: int, shard_count: int, steal_after: float = None):
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"shard_index must be in [0, {shard_count})")
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.steal_after = steal_after
+        self.wake()
+
+
+    @staticmethod
+    def fire_time(schedule):
+        # A schedule that has never run is due immediately
+        if not schedule.last_run:
+            return datetime.datetime.now()
+        return schedule.next_run
+
+
+    def is_owned(self, schedule_id):
+        return schedule_id % self.shard_count == self.shard_index
+
+
+    def _entry_time(self, schedule):
+        fire_time = self.fire_time(schedule)
+        if self.steal_after and not self.is_owned(schedule.id):
+            fire_time += datetime.timedelta(seconds=self.steal_after)
+        return fire_time
+
+
+    def wake(self):
+        with self._cond:
+            self._needs_reload = True
+            self._cond.notify_all()
+
+
+    def reload(self):
+        schedules = DCASchedule.select(
+            DCASchedule.id,
+            DCASchedule.last_run,
+            DCASchedule.repeat_duration,
+            DCASchedule.repeat_timescale,
+        ).where(
+            (DCASchedule.is_paused == False) & (DCASchedule.is_active == True)
+        )
+        if self.shard_count > 1 and not self.steal_after:
+            schedules = schedules.where(DCASchedule.id % self.shard_count == self.shard_index)
+
+        with self._cond:
+            self._needs_reload = False
+            self._generation += 1
+            self._heap = [(self._entry_time(s), s.id, self._generation) for s in schedules]
+            heapq.heapify(self._heap)
+
+
+    def push(self, schedule, at=None):
+        """
+            Queues `schedule` at its next fire time, or at `at` to defer it.
+        """
+        with self._cond:
+            heapq.heappush(self._heap, (at or self._entry_time(schedule), schedule.id, self._generation))
+            self._cond.notify_all()
+
+
+    def pop_due(self, now=None):
+        """
+            Removes and returns `(schedule_id, fire_time)` for every schedule whose
+            fire time has passed.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                fire_time, schedule_id, generation = heapq.heappop(self._heap)
+                if generation == self._generation:
+                    due.append((schedule_id, fire_time))
+        return due
+
+
+    def wait(self, max_timeout=None):
+        """
+            Blocks until the earliest schedule is due, `wake()` is called, or
+            `max_timeout` seconds have elapsed.
+        """
+        with self._cond:
+            if self._needs_reload:
+                return
+
+            timeout = max_timeout
+            if self._heap:
+                until_next = (self._heap[0][0] - datetime.datetime.now()).total_seconds()
+                timeout = until_next if timeout is None else min(timeout, until_next)
+
+            if timeout is None or timeout > 0:
+                self._cond.wait(timeout)
+
+
+    @property
+    def needs_reload(self):
+        return self._needs_reload
+
+
+    def __len__(self):
+        return len(self._heap)
+
+
+
+schedule_queue = ScheduleQueue()
+
+
+
+def notify_schedules_changed():
+    """
+        Called by the Flask routes whenever a schedule is created, paused, unpaused,
+        or deleted so an in-process daemon picks up the change immediately.
+    """
+    schedule_queue.wake()
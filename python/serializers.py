@@ -0,0 +1,123 @@
+import csv
+import datetime
+import io
+import json
+
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    # Optional; the stdlib encoder produces the same output, just slower
+    orjson = None
+
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+
+def dumps(data):
+    if orjson:
+        # orjson encodes datetimes natively (also as isoformat) and hands us Decimals
+        return orjson.dumps(data, default=_default)
+    return json.dumps(data, default=_default)
+
+
+
+def json_response(data):
+    # Flask is imported on use so the daemon, which shares this module, never loads it
+    from flask import Response
+    return Response(dumps(data), mimetype="application/json")
+
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+
+def _attachment(filename):
+    return {"Content-Disposition": f"attachment; filename={filename}"}
+
+
+
+def csv_response(header, rows, filename):
+    """
+        Streams `rows` (an iterable of tuples, typically a lazy query) as CSV so the
+        whole result is never held in memory.
+    """
+    def stream():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow([_csv_value(value) for value in row])
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    from flask import Response
+    return Response(stream(), mimetype="text/csv", headers=_attachment(filename))
+
+
+
+def ndjson_response(header, rows, filename):
+    """
+        Streams `rows` (an iterable of tuples) as newline-delimited JSON objects keyed
+        by `header`.
+    """
+    def join(lines):
+        newline = b"\n" if isinstance(lines[0], bytes) else "\n"
+        return newline.join(lines) + newline
+
+    def stream():
+        lines = []
+        for row in rows:
+            lines.append(dumps(dict(zip(header, row))))
+            if len(lines) >= 1000:
+                yield join(lines)
+                lines = []
+        if lines:
+            yield join(lines)
+
+    from flask import Response
+    return Response(stream(), mimetype="application/x-ndjson", headers=_attachment(filename))
+
+
+
+class ModelSerializer(object):
+    """
+        Flat (non-recursive) dict serializer for a peewee model.
+
+        The field list is resolved once up front rather than on every row like
+        `model_to_dict`; foreign keys are emitted as their raw id and Decimals as floats.
+    """
+    def __init__(self, model, exclude=None):
+        exclude = set(exclude or [])
+        self.field_names = [f.name for f in model._meta.sorted_fields if f not in exclude]
+        self.decimal_field_names = set(
+            f.name for f in model._meta.sorted_fields if f not in exclude and f.field_type == 'DECIMAL'
+        )
+
+
+    def to_dict(self, instance):
+        data = instance.__data__
+        result = {}
+        for name in self.field_names:
+            value = data.get(name)
+            if value is not None and name in self.decimal_field_names:
+                value = float(value)
+            result[name] = value
+        return result
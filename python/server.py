@@ -9,6 +9,7 @@ from decimal import Decimal
 from flask import (
     Flask,
     Blueprint,
+    Response,
     render_template,
     request,
     redirect,
@@ -16,10 +17,15 @@ from flask import (
     jsonify,
 )
 
+import events
+import metrics
+
 from blueprints.credentials import credentials_routes
 from blueprints.orders import orders_routes
-from models import APICredential, DCASchedule, Order
-from exchanges.gemini import GeminiExchange, GeminiRequestException
+from blueprints.schedules import schedules_routes
+from models import create_tables, db, APICredential, DCASchedule, Order
+from scheduler import notify_schedules_changed
+from serializers import json_response
 
 
 
@@ -38,8 +44,54 @@ app = Flask(__name__,
 
 # app.config["EXPLAIN_TEMPLATE_LOADING"] = True
 
+logger = logging.getLogger(__name__)
+
+# Cleared by `start_background_startup` while it migrates the db and starts the daemon
+#   in the background, so the server can answer (and the window show `/ready`) right
+#   away. Set whenever the app is used any other way.
+ready = threading.Event()
+ready.set()
+startup_error = None
+
 app.register_blueprint(credentials_routes, url_prefix="/credentials")
 app.register_blueprint(orders_routes, url_prefix="/orders")
+app.register_blueprint(schedules_routes, url_prefix="/schedules")
+
+
+
+@app.before_request
+def open_db_connection():
+    if request.endpoint == "readiness":
+        return
+    if not ready.is_set():
+        # Nothing may touch the db until it's been migrated
+        return Response(
+            "<meta http-equiv='refresh' content='1'>Starting up...",
+            status=503,
+            headers={"Retry-After": "1"}
+        )
+    db.connect(reuse_if_open=True)
+
+
+
+@app.teardown_request
+def close_db_connection(exc):
+    if not db.is_closed():
+        db.close()
+
+
+
+@app.route("/ready")
+def readiness():
+    """
+        200 once startup has finished, 503 while it's still running, 500 if it failed.
+        Never touches the db, so it answers as soon as the server is listening.
+    """
+    if startup_error:
+        return jsonify({"ready": False, "error": startup_error}), 500
+    if not ready.is_set():
+        return jsonify({"ready": False}), 503
+    return jsonify({"ready": True})
 
 
 
@@ -50,27 +102,61 @@ def home():
 
 
 
+@app.route("/metrics")
+def prometheus_metrics():
+    # Includes the daemon's metrics when it runs as a thread (`--daemon`); a separate
+    #   daemon process serves its own via `--metrics-port`.
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+
+@app.route("/events")
+def event_stream():
+    """
+        Server-sent events: `order` whenever an Order is placed or changes status and
+        `schedule_fired` when the daemon runs a schedule.
+    """
+    subscriber = events.bus.subscribe()
+
+    def stream():
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                event = subscriber.get(timeout=events.KEEPALIVE_INTERVAL)
+                yield event.to_sse() if event else ": keepalive\n\n"
+        finally:
+            events.bus.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+
+def schedule_from_form(credential):
+    # Unsaved; shared by create_schedule and backtest_schedule
+    return DCASchedule(
+        credential=credential,
+        market_name=request.form['market_name'],
+        order_side=request.form['order_side'].lower(),
+        amount=Decimal(request.form['amount']),
+        amount_currency=request.form['amount_currency'],
+        repeat_duration=int(request.form['repeat_duration']),
+        repeat_timescale=request.form['repeat_timescale'],
+        catch_up_policy=request.form.get('catch_up_policy', DCASchedule.CATCH_UP__ONCE)
+    )
+
+
+
 @app.route("/schedule/create/<credential_id>", methods=('GET', 'POST'))
 def create_schedule(credential_id):
     credential = APICredential.get(id=credential_id)
 
     if request.method == 'POST':
-        market_name = request.form['market_name']
-        order_side = request.form['order_side'].lower()
-        amount = Decimal(request.form['amount'])
-        amount_currency = request.form['amount_currency']
-        repeat_duration = Decimal(request.form['repeat_duration'])
-        repeat_timescale = request.form['repeat_timescale']
-
-        schedule = DCASchedule.create(
-            credential=credential,
-            market_name=market_name,
-            order_side=order_side,
-            amount=amount,
-            amount_currency=amount_currency,
-            repeat_duration=repeat_duration,
-            repeat_timescale=repeat_timescale
-        )
+        schedule = schedule_from_form(credential)
+        schedule.save()
+        notify_schedules_changed()
 
         return redirect(url_for('credentials.view_credential', credential_id=credential.id))
 
@@ -80,10 +166,37 @@ def create_schedule(credential_id):
         DAYS=DCASchedule.DAYS,
         HOURS=DCASchedule.HOURS,
         MINUTES=DCASchedule.MINUTES,
+        CATCH_UP__SKIP=DCASchedule.CATCH_UP__SKIP,
+        CATCH_UP__ONCE=DCASchedule.CATCH_UP__ONCE,
+        CATCH_UP__EACH=DCASchedule.CATCH_UP__EACH,
     )
 
 
 
+@app.route("/schedule/backtest/<credential_id>", methods=['POST'])
+def backtest_schedule(credential_id):
+    """
+        Replays the create schedule form's settings over an uploaded OHLC candle CSV
+        (`candles` file field) without saving anything; see `backtest.py`.
+    """
+    import io
+    from backtest import Backtester, load_candles
+    from exchanges.base import get_exchange
+
+    credential = APICredential.get(id=credential_id)
+    schedule = schedule_from_form(credential)
+
+    exchange = get_exchange(credential)
+    if not hasattr(exchange, "initialize_market"):
+        return jsonify({"error": f"Backtesting isn't supported for {credential.exchange}"}), 400
+    market = exchange.initialize_market(schedule.market_name, schedule.amount_currency, schedule.order_side)
+
+    candles = load_candles(io.TextIOWrapper(request.files['candles'].stream, encoding="utf-8"))
+    result = Backtester(candles, market).run(schedule)
+    return json_response(result.to_dict())
+
+
+
 @app.route("/schedule/update/<schedule_id>", methods=('GET', 'POST'))
 def update_schedule(credential_id):
     schedule = DCASchedule.get(id=schedule_id)
@@ -98,6 +211,9 @@ def update_schedule(credential_id):
         DAYS=DCASchedule.DAYS,
         HOURS=DCASchedule.HOURS,
         MINUTES=DCASchedule.MINUTES,
+        CATCH_UP__SKIP=DCASchedule.CATCH_UP__SKIP,
+        CATCH_UP__ONCE=DCASchedule.CATCH_UP__ONCE,
+        CATCH_UP__EACH=DCASchedule.CATCH_UP__EACH,
     )
 
 
@@ -108,8 +224,9 @@ def pause_schedule(schedule_id):
     schedule.is_active = True;
     schedule.is_paused = True;
     schedule.save()
+    notify_schedules_changed()
 
-    return redirect(url_for('credentials.view_credential', credential_id=schedule.credential.id))
+    return redirect(url_for('credentials.view_credential', credential_id=schedule.credential_id))
 
 
 
@@ -118,8 +235,9 @@ def unpause_schedule(schedule_id):
     schedule = DCASchedule.get(id=schedule_id)
     schedule.is_paused = False;
     schedule.save()
+    notify_schedules_changed()
 
-    return redirect(url_for('credentials.view_credential', credential_id=schedule.credential.id))
+    return redirect(url_for('credentials.view_credential', credential_id=schedule.credential_id))
 
 
 
@@ -128,17 +246,61 @@ def delete_schedule(schedule_id):
     schedule = DCASchedule.get(id=schedule_id)
 
     if request.method == 'POST':
-        credential_id = schedule.credential.id
+        credential_id = schedule.credential_id
         schedule.delete_instance()
+        notify_schedules_changed()
 
         return redirect(url_for('credentials.view_credential', credential_id=credential_id))
 
 
 
+def startup(start_daemon=False, max_workers=None, stream_market_data=False):
+    """
+        Migrates the db and starts the event relay (and optionally the daemon), then
+        sets `ready`; a failure is reported by `/ready`.
+    """
+    global startup_error
+    try:
+        # Creates sqlite DB tables if necessary
+        create_tables()
+
+        if stream_market_data:
+            from exchanges.market_data import gemini_market_data
+            gemini_market_data.enable()
+
+        # Picks up events from a daemon running as its own process
+        events.bus.start_relay()
+
+        if start_daemon:
+            import werkzeug
+
+            # Start the schedule runner thread
+            # Prevent duplicates from being created by hot reloads
+            if not werkzeug.serving.is_running_from_reloader():
+                from daemon import timer_thread, DEFAULT_MAX_WORKERS
+                x = threading.Thread(target=timer_thread, kwargs={"max_workers": max_workers or DEFAULT_MAX_WORKERS}, daemon=True)
+                x.start()
+
+        ready.set()
+    except Exception as e:
+        logger.exception(f"Startup failed: {e}")
+        startup_error = str(e)
+
+
+
+def start_background_startup(**kwargs):
+    """
+        Runs `startup` on its own thread so the server can start listening straight
+        away; `/ready` reports when it's done. Used by both entry points (`__main__`
+        below and the packaged `app.py`).
+    """
+    ready.clear()
+    threading.Thread(target=startup, kwargs=kwargs, daemon=True, name="startup").start()
+
+
+
 if __name__ == "__main__":
     import argparse
-    import werkzeug
-    from models import create_tables
 
     parser = argparse.ArgumentParser(
         description="""
@@ -153,19 +315,39 @@ if __name__ == "__main__":
                         default=False,
                         dest="start_daemon",
                         help="Start the background daemon")
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=None,
+                        dest="max_workers",
+                        help="Max number of orders the daemon places concurrently")
+    parser.add_argument('-s', '--stream-market-data',
+                        action="store_true",
+                        default=False,
+                        dest="stream_market_data",
+                        help="Price orders from a live websocket top-of-book feed")
+
+    parser.add_argument('--gemini-api-url',
+                        default=None,
+                        dest="gemini_api_url",
+                        help="Gemini REST API base url (e.g. https://api.sandbox.gemini.com/v1)")
+
+    parser.add_argument('--log-level',
+                        default="INFO",
+                        dest="log_level",
+                        help="DEBUG, INFO, WARNING, or ERROR")
 
     args = parser.parse_args()
-    start_daemon = args.start_daemon
-
-    # Creates sqlite DB tables if necessary
-    create_tables()
-
-    if start_daemon:
-        # Start the schedule runner thread
-        # Prevent duplicates from being created by hot reloads
-        if not werkzeug.serving.is_running_from_reloader():
-            from daemon import timer_thread
-            x = threading.Thread(target=timer_thread, daemon=True)
-            x.start()
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.gemini_api_url:
+        from exchanges.gemini import GeminiApiConnection
+        GeminiApiConnection.set_base_url(args.gemini_api_url)
+
+    start_background_startup(
+        start_daemon=args.start_daemon,
+        max_workers=args.max_workers,
+        stream_market_data=args.stream_market_data,
+    )
 
     app.run(port=61712)
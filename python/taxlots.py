@@ -0,0 +1,203 @@
+import datetime
+import heapq
+import itertools
+
+from collections import deque
+
+from models import iterate_query, Fill
+
+
+
+# Lot selection methods: which open lot a sale is matched against first
+FIFO = "fifo"       # oldest
+LIFO = "lifo"       # newest
+HIFO = "hifo"       # highest cost
+METHODS = (FIFO, LIFO, HIFO)
+
+# Held longer than this counts as a long-term gain
+LONG_TERM = datetime.timedelta(days=365)
+
+# Quantities are floats (see `Fill`); anything smaller than this is rounding dust
+DUST = 1e-12
+
+# Output precision; lots are matched at full precision and only rounded when yielded
+QUANTITY_PLACES = 8         # satoshis
+MONEY_PLACES = 2            # cents
+
+HEADER = [
+    "market_name",
+    "quantity",
+    "acquired",
+    "disposed",
+    "term",
+    "cost_basis",
+    "proceeds",
+    "gain",
+    "buy_order_id",
+    "sell_order_id",
+]
+
+
+
+class Lot(object):
+    __slots__ = ("order_id", "acquired", "quantity", "unit_cost")
+
+    def __init__(self, order_id, acquired, quantity, unit_cost):
+        self.order_id = order_id
+        self.acquired = acquired
+        self.quantity = quantity
+        self.unit_cost = unit_cost          # fees included
+
+
+
+class OpenLots(object):
+    """
+        The lots still held in one market, ordered for the selection method. `pop`
+        returns the next lot to sell from; a partially sold lot goes back with
+        `put_back` so it's next again.
+    """
+    def __init__(self, method: str):
+        if method not in METHODS:
+            raise ValueError(f"Lot method must be one of {', '.join(METHODS)}")
+        self.method = method
+        self._lots = deque() if method == FIFO else []
+        self._seq = itertools.count()
+
+
+    def __bool__(self):
+        return bool(self._lots)
+
+
+    def add(self, lot):
+        if self.method == HIFO:
+            heapq.heappush(self._lots, (-lot.unit_cost, next(self._seq), lot))
+        else:
+            self._lots.append(lot)
+
+
+    def pop(self):
+        if self.method == FIFO:
+            return self._lots.popleft()
+        elif self.method == LIFO:
+            return self._lots.pop()
+        return heapq.heappop(self._lots)[2]
+
+
+    def put_back(self, lot):
+        if self.method == FIFO:
+            self._lots.appendleft(lot)
+        else:
+            self.add(lot)
+
+
+    def drain(self):
+        while self._lots:
+            yield self.pop()
+
+
+
+def _term(acquired, disposed):
+    return "long" if disposed - acquired > LONG_TERM else "short"
+
+
+
+def _row(market_name, quantity, acquired, disposed, term, cost_basis, proceeds, buy_order_id, sell_order_id):
+    """
+        A row in `HEADER` order, rounded for output. The gain is taken from the rounded
+        amounts so the columns add up.
+    """
+    def money(value):
+        return None if value is None else round(value, MONEY_PLACES)
+
+    cost_basis = money(cost_basis)
+    proceeds = money(proceeds)
+    gain = None if cost_basis is None or proceeds is None else money(proceeds - cost_basis)
+    return (
+        market_name, round(quantity, QUANTITY_PLACES), acquired, disposed, term,
+        cost_basis, proceeds, gain, buy_order_id, sell_order_id
+    )
+
+
+
+def dispose(lots: OpenLots, market_name, order_id, disposed, quantity, notional, fee):
+    """
+        Matches a sale against the open lots, yielding one row per lot it draws from.
+        Any quantity beyond what's held (e.g. bought outside this app) is yielded with
+        an unknown cost basis.
+    """
+    proceeds_per_unit = (notional - fee) / quantity
+    remaining = quantity
+    while remaining > DUST and lots:
+        lot = lots.pop()
+        used = min(lot.quantity, remaining)
+        yield _row(
+            market_name, used, lot.acquired, disposed, _term(lot.acquired, disposed),
+            used * lot.unit_cost, used * proceeds_per_unit, lot.order_id, order_id
+        )
+
+        lot.quantity -= used
+        remaining -= used
+        if lot.quantity > DUST:
+            lots.put_back(lot)
+
+    if remaining > DUST:
+        yield _row(market_name, remaining, None, disposed, None, None, remaining * proceeds_per_unit, None, order_id)
+
+
+
+def tax_lot_rows(credential_id, method: str = FIFO, year: int = None, include_open: bool = False):
+    """
+        Yields a row (in `HEADER` order) per lot disposed of, computed incrementally
+        while streaming the credential's fills in time order; only the open lots of
+        the current market are held in memory.
+
+        With `year`, only disposals in that year are yielded, though every earlier fill
+        is still matched. `include_open` adds a row per lot still held at the end (at
+        the end of `year`), with no disposal.
+    """
+    query = Fill.select(
+        Fill.market_name,
+        Fill.order,
+        Fill.is_buy,
+        Fill.quantity,
+        Fill.notional,
+        Fill.fee,
+        Fill.filled_at,
+    ).where(
+        Fill.credential == credential_id
+    ).order_by(
+        Fill.market_name, Fill.filled_at, Fill.id
+    ).tuples()
+    if year:
+        query = query.where(Fill.filled_at < datetime.datetime(year + 1, 1, 1))
+
+    def open_rows(market_name, lots):
+        for lot in lots.drain():
+            yield _row(market_name, lot.quantity, lot.acquired, None, None, lot.quantity * lot.unit_cost, None, lot.order_id, None)
+
+    lots = None
+    current_market = None
+    for market_name, order_id, is_buy, quantity, notional, fee, filled_at in iterate_query(query):
+        if market_name != current_market:
+            if include_open and lots:
+                yield from open_rows(current_market, lots)
+            current_market = market_name
+            lots = OpenLots(method)
+
+        if quantity <= DUST:
+            continue
+
+        if is_buy:
+            lots.add(Lot(order_id, filled_at, quantity, (notional + fee) / quantity))
+            continue
+
+        disposals = dispose(lots, market_name, order_id, filled_at, quantity, notional, fee)
+        if year and filled_at.year != year:
+            # Still consumes the lots
+            for _ in disposals:
+                pass
+        else:
+            yield from disposals
+
+    if include_open and lots:
+        yield from open_rows(current_market, lots)